@@ -3,16 +3,39 @@ from nova import datastore
 
 KEEPER = datastore.keeper('fakeldap')
 
+# attributes looked up on every request get an index instead of a scan
+INDEXED = ['accessKey']
+for attr in INDEXED:
+    KEEPER.add_index(attr)
+
 SCOPE_SUBTREE  = 1
 
 class NO_SUCH_OBJECT(Exception):
     pass
 
 def initialize(uri):
+    _migrate()
     return FakeLDAP(uri)
 
-if KEEPER['objects'] is None:
-    KEEPER['objects'] = {}
+def _subtree_key(dn):
+    """ Objects are stored under their DN with the RDNs reversed, so that
+    everything below a DN shares its key as a prefix. """
+    return ','.join(reversed(dn.split(',')))
+
+_migrated = False
+
+def _migrate():
+    """ Split the old single 'objects' value into one key per object """
+    global _migrated
+    if _migrated:
+        return
+    objects = KEEPER['objects']
+    if objects is not None:
+        with KEEPER.transaction():
+            for cn, attrs in objects.iteritems():
+                KEEPER[_subtree_key(cn)] = attrs
+            del KEEPER['objects']
+    _migrated = True
 
 class FakeLDAP(object):
     def __init__(self, uri):
@@ -20,28 +43,31 @@ class FakeLDAP(object):
 
     def simple_bind_s(self, dn, password):
         pass
-    
+
     def unbind_s(self):
         pass
 
     def search_s(self, dn, scope, query=None, fields=None):
         logging.debug("searching for %s" % dn)
-        filtered = {}
-        d = KEEPER['objects']
-        for cn, attrs in d.iteritems():
-            if cn[-len(dn):] == dn:
-                filtered[cn] = attrs
+        base = _subtree_key(dn)
+        k = v = None
         if query:
             k,v = query[1:-1].split('=')
-            objects = {}
-            for cn, attrs in filtered.iteritems():
-                if attrs.has_key(k) and (v in attrs[k] or
-                    v == attrs[k]):
-                    objects[cn] = attrs
+        if k in INDEXED:
+            candidates = KEEPER.find(k, v)
+        else:
+            candidates = KEEPER.scan(base)
+        objects = {}
+        for key, attrs in candidates:
+            if key != base and not key.startswith(base + ','):
+                continue
+            if k is None or (attrs.has_key(k) and (v in attrs[k] or
+                v == attrs[k])):
+                objects[_subtree_key(key)] = attrs
         if objects == {}:
             raise NO_SUCH_OBJECT()
         return objects.items()
-    
+
     def add_s(self, cn, attr):
         logging.debug("adding %s" % cn)
         stored = {}
@@ -50,12 +76,10 @@ class FakeLDAP(object):
                 stored[k] = v
             else:
                 stored[k] = [v]
-        d = KEEPER['objects']
-        d[cn] = stored
-        KEEPER['objects'] = d
+        KEEPER[_subtree_key(cn)] = stored
 
     def delete_s(self, cn):
         logging.debug("creating for %s" % cn)
-        d = KEEPER['objects']
-        del d[cn]
-        KEEPER['objects'] = d
+        if KEEPER[_subtree_key(cn)] is None:
+            raise NO_SUCH_OBJECT()
+        del KEEPER[_subtree_key(cn)]
@@ -1,5 +1,6 @@
 
 #!/usr/bin/env python
+import copy
 import datetime
 import logging
 import os
@@ -86,6 +87,7 @@ class User(object):
         port_map = KEEPER['vpn_ports']
         if not port_map: port_map = {}
         if not port_map.has_key(self.id):
+            port_map = copy.deepcopy(port_map)
             ports = port_map.values()
             if len(ports) > 0:
                 port_map[self.id] = max(ports) + 1
@@ -0,0 +1,8 @@
+"""
+Offline benchmarks for comparing nova internals before deploying changes.
+
+Each module runs standalone, e.g.::
+
+    python -m nova.benchmark.keeper --bench_users=10000
+    python -m nova.benchmark.cluster --fake_rabbit --cluster_nodes=1,10,100
+"""
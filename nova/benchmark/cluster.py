@@ -0,0 +1,319 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Cluster benchmark.
+
+Runs a CloudController and N simulated compute and volume nodes in one
+process, over fakerabbit or a local broker.  Compute nodes use fakevirt and
+volume nodes FakeBlockStore; each reports its state on an interval, as the
+real daemons do, while API clients loop over run_instances,
+describe_instances and terminate_instances.  For each N it reports the
+controller's share of CPU, bus message rates and API latency, to show
+where a single nova-api stops keeping up::
+
+    python -m nova.benchmark.cluster --fake_rabbit \\
+        --fake_rabbit_delivery=deferred --cluster_nodes=1,10,100
+"""
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import nova.contrib
+from tornado import ioloop
+from twisted.internet import defer
+
+from nova import exception
+from nova import fakerabbit
+from nova import flags
+from nova import rpc
+from nova.auth import users
+from nova.compute import node
+from nova.endpoint import api
+from nova.endpoint import cloud
+from nova.volume import storage
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list('cluster_nodes', ['1', '10', '50'],
+                  'cluster sizes to run, as compute (and volume) node counts')
+flags.DEFINE_integer('cluster_duration', 30, 'seconds to run each size for')
+flags.DEFINE_integer('cluster_clients', 4, 'concurrent api clients')
+flags.DEFINE_integer('cluster_users', 4, 'users the clients act as')
+flags.DEFINE_integer('cluster_launch_count', 1,
+                     'instances asked for by each run_instances')
+flags.DEFINE_integer('cluster_report_interval', 10,
+                     'seconds between each node reporting its state')
+flags.DEFINE_integer('cluster_client_instances', 3,
+                     'most instances each client keeps running at once')
+flags.DEFINE_float('cluster_error_backoff', 0.5,
+                   'seconds a client waits after a failed request')
+
+
+class InlinePool(object):
+    """ Stands in for a node's process pool; fake images build instantly """
+    def apply_async(self, func, args, callback=None):
+        rv = func(*args)
+        if callback:
+            callback(rv)
+
+
+class SimulatedNode(node.Node):
+    """ A compute node that reports under its own name """
+    def __init__(self, name):
+        # Node.__init__ would start four processes per node
+        node.GenericNode.__init__(self)
+        self.name = name
+        self._instances = {}
+        self._conn = self._get_connection()
+        self._pool = InlinePool()
+
+    def run_instance(self, instance_id, **kwargs):
+        """ Boot instantly; Node.run_instance's Deferred never fires """
+        if instance_id in self._instances:
+            raise exception.Error(
+                    'attempting to use existing instance_id: %s' % instance_id)
+        inst = node.Instance(self._conn, name=instance_id, pool=self._pool,
+                             **kwargs)
+        inst._s['state'] = node.Instance.RUNNING
+        self._instances[instance_id] = inst
+        return defer.succeed(inst.describe())
+
+    def terminate_instance(self, instance_id):
+        """ Shut down instantly, rather than polling the fake domain """
+        if instance_id not in self._instances:
+            raise exception.Error(
+                    'trying to terminate unknown instance: %s' % instance_id)
+        inst = self._instances.pop(instance_id)
+        inst._s['state'] = node.Instance.SHUTOFF
+        return defer.succeed(None)
+
+    @defer.inlineCallbacks
+    def report_state(self):
+        rv = yield self.describe_instances()
+        rpc.cast(FLAGS.cloud_topic, {"method": "update_state",
+                                     "args": {"topic": "instances",
+                                              "value": {self.name: rv}}})
+
+
+class SimulatedBlockStore(storage.FakeBlockStore):
+    """ A volume node that reports under its own name """
+    def __init__(self, name):
+        super(SimulatedBlockStore, self).__init__()
+        self.name = name
+
+    def describe_volumes(self):
+        volumes = super(SimulatedBlockStore, self).describe_volumes()
+        return {self.name: volumes[FLAGS.storage_name]}
+
+
+class Client(object):
+    """ Launches, lists and terminates instances as one user, one request
+    at a time, recording the latency of each.  It only terminates what it
+    launched itself, and keeps at most FLAGS.cluster_client_instances
+    running so the user's network doesn't run out of addresses. """
+    def __init__(self, controller, user, rng, timings, errors):
+        self.controller = controller
+        self.context = api.APIRequestContext(handler=None, user=user)
+        self.rng = rng
+        self.timings = timings
+        self.errors = errors
+        self.instances = set()
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self._next()
+
+    def stop(self):
+        self.running = False
+
+    def _next(self):
+        if not self.running:
+            return
+        op = self.rng.choice(['run_instances', 'describe_instances',
+                              'describe_instances', 'terminate_instances'])
+        if (op == 'run_instances' and
+                len(self.instances) >= FLAGS.cluster_client_instances):
+            op = 'terminate_instances'
+        start = time.time()
+        try:
+            d = getattr(self, op)()
+        except Exception:
+            d = defer.fail()
+        d.addCallbacks(lambda rv: self._done(op, start),
+                       lambda f: self._failed(op))
+
+    def _done(self, op, start):
+        self.timings.setdefault(op, []).append(time.time() - start)
+        ioloop.IOLoop.instance().add_callback(self._next)
+
+    def _failed(self, op):
+        """ Count the error and back off rather than retry at once """
+        self.errors[op] = self.errors.get(op, 0) + 1
+        ioloop.IOLoop.instance().add_timeout(
+                time.time() + FLAGS.cluster_error_backoff, self._next)
+
+    @defer.inlineCallbacks
+    def run_instances(self):
+        rv = yield self.controller.run_instances(
+                self.context, image_id=FLAGS.default_image,
+                instance_type='m1.tiny',
+                max_count=FLAGS.cluster_launch_count)
+        for reservation in rv['reservationSet']:
+            for instance in reservation['instances_set']:
+                self.instances.add(instance['instance_id'])
+        defer.returnValue(rv)
+
+    def describe_instances(self):
+        return self.controller.describe_instances(self.context)
+
+    def terminate_instances(self):
+        # pending instances can't be terminated until a node reports them
+        pending = self.controller.instances.get('pending', {})
+        mine = [instance_id for instance_id in self.instances
+                if instance_id not in pending]
+        if not mine:
+            return self.describe_instances()
+        instance_id = self.rng.choice(mine)
+        self.instances.discard(instance_id)
+        return self.controller.terminate_instances(
+                self.context, [instance_id])
+
+
+def _percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+
+def _cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _messages():
+    """ Messages published so far, from the rpc publish timings """
+    return sum(stages['publish'].count
+               for methods in rpc._stats.values()
+               for stages in methods.values()
+               if 'publish' in stages)
+
+
+def run(size, user_objs):
+    """ Run a cluster of size nodes for FLAGS.cluster_duration seconds """
+    io_inst = ioloop.IOLoop.instance()
+    conn = rpc.Connection.instance()
+    rng = random.Random(size)
+    injected = []
+    timers = []
+    starts = []
+
+    controller = cloud.CloudController()
+    injected.append(rpc.AdapterConsumer(
+            connection=conn, topic=FLAGS.cloud_topic,
+            proxy=controller).attach_to_tornado(io_inst))
+
+    for i in xrange(size):
+        for proxy, topic in (
+                (SimulatedNode('compute%d' % i), FLAGS.compute_topic),
+                (SimulatedBlockStore('volume%d' % i), FLAGS.storage_topic)):
+            for key in (topic, '%s.%s' % (topic, proxy.name)):
+                injected.append(rpc.AdapterConsumer(
+                        connection=conn, topic=key,
+                        proxy=proxy).attach_to_tornado(io_inst))
+            timer = ioloop.PeriodicCallback(
+                    proxy.report_state,
+                    FLAGS.cluster_report_interval * 1000, io_loop=io_inst)
+            timers.append(timer)
+            # spread the reports out rather than having them all land at once
+            starts.append(io_inst.add_timeout(
+                    time.time() + rng.random() * FLAGS.cluster_report_interval,
+                    timer.start))
+
+    # the controller's cpu is the time it spends in its rpc handlers plus
+    # the api calls the clients make of it
+    timings = {}
+    errors = {}
+    clients = [Client(controller, user_objs[i % len(user_objs)],
+                      random.Random(i), timings, errors)
+               for i in xrange(FLAGS.cluster_clients)]
+    for client in clients:
+        io_inst.add_callback(client.start)
+
+    rpc._stats.clear()
+    fake_before = FLAGS.fake_rabbit and fakerabbit.stats() or {}
+    cpu = _cpu()
+    start = time.time()
+    io_inst.add_timeout(start + FLAGS.cluster_duration, io_inst.stop)
+    io_inst.start()
+    elapsed = time.time() - start
+    cpu = _cpu() - cpu
+
+    for client in clients:
+        client.stop()
+    for timer in timers:
+        timer.stop()
+    for timeout in starts:
+        # those that haven't fired yet mustn't start in the next run
+        try:
+            io_inst.remove_timeout(timeout)
+        except ValueError:
+            pass
+    for x in injected:
+        x.stop()
+
+    handler = sum(sum(seconds for when, seconds in stages['handler'].samples)
+                  for stages in rpc._stats.get(FLAGS.cloud_topic, {}).values()
+                  if 'handler' in stages)
+    api_time = sum(sum(samples) for samples in timings.values())
+    latencies = sorted(sum(timings.values(), []))
+    sent = 0
+    if FLAGS.fake_rabbit:
+        fake_after = fakerabbit.stats()
+        sent = sum(stats['bytes'] - fake_before.get(name, {}).get('bytes', 0)
+                    for name, stats in fake_after.items())
+    return {'cpu': cpu / elapsed * 100,
+            'controller': (handler + api_time) / elapsed * 100,
+            'msgs': _messages() / elapsed,
+            'bytes': sent / elapsed,
+            'requests': len(latencies) / elapsed,
+            'p50': latencies and _percentile(latencies, 50) * 1000 or 0,
+            'p99': latencies and _percentile(latencies, 99) * 1000 or 0,
+            'errors': sum(errors.values()),
+            'outstanding': rpc.outstanding_calls()}
+
+
+def main(argv):
+    path = tempfile.mkdtemp(prefix='cluster-bench-')
+    FLAGS.datastore_path = path
+    FLAGS.instances_path = path
+    FLAGS.fake_libvirt = True
+    FLAGS.fake_network = True
+    FLAGS.fake_storage = True
+    FLAGS.fake_users = True
+    try:
+        manager = users.UserManager.instance()
+        user_objs = []
+        for i in xrange(FLAGS.cluster_users):
+            name = 'cluster%d' % i
+            # admins, since is_authorized has no action to check another
+            # user's instances against and describe_instances would fail
+            user_objs.append(manager.get_user(name) or
+                             manager.create_user(name, name, name, admin=True))
+
+        print ('%6s %7s %7s %9s %11s %8s %9s %9s %7s %8s' %
+               ('nodes', 'cpu %', 'ctl %', 'msgs/s', 'bytes/s', 'api/s',
+                'p50 ms', 'p99 ms', 'errors', 'waiting'))
+        for size in FLAGS.cluster_nodes:
+            stats = run(int(size), user_objs)
+            print ('%6s %7.1f %7.1f %9.1f %11.1f %8.1f %9.3f %9.3f %7d %8d' %
+                   (size, stats['cpu'], stats['controller'], stats['msgs'],
+                    stats['bytes'], stats['requests'], stats['p50'],
+                    stats['p99'], stats['errors'], stats['outstanding']))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(FLAGS(sys.argv))
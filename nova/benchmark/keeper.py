@@ -0,0 +1,248 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Keeper benchmark.
+
+Drives datastore.keeper with the key shapes nova actually writes (per-user
+network blobs, the public address map, vpn_ports, volume records and
+fakeldap objects) against every combination of backend, value format and
+cache setting, and reports ops/sec, p50/p99 latency and bytes written per
+op.  Everything runs in a scratch directory, so no nova services are
+needed::
+
+    python -m nova.benchmark.keeper --bench_users=10000 \\
+        --bench_addresses=50000
+"""
+import copy
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import nova.contrib
+from nova import datastore
+from nova import flags
+from nova import utils
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer('bench_users', 1000, 'number of users to simulate')
+flags.DEFINE_integer('bench_addresses', 5000,
+                     'number of allocated public addresses')
+flags.DEFINE_integer('bench_hosts', 16, 'hosts in each private network')
+flags.DEFINE_integer('bench_ops', 2000, 'timed operations per workload')
+flags.DEFINE_list('bench_backends', ['file', 'log'], 'backends to compare')
+flags.DEFINE_list('bench_formats', ['json', 'marshal'],
+                  'value formats to compare')
+flags.DEFINE_list('bench_cache_sizes', ['0', '512'],
+                  'datastore_cache_size settings to compare')
+flags.DEFINE_list('bench_workloads',
+                  ['network', 'public', 'vpn_ports', 'volumes', 'ldap'],
+                  'workloads to run')
+
+
+def _host(user_id, address):
+    return {'address': address, 'user_id': user_id,
+            'mac': utils.generate_mac()}
+
+
+class Workload(object):
+    """ setup() populates the store untimed, op() is one timed operation """
+    def __init__(self, rng):
+        self.rng = rng
+        self.users = ['user%d' % i for i in xrange(FLAGS.bench_users)]
+
+    def setup(self):
+        pass
+
+    def op(self):
+        raise NotImplementedError()
+
+
+class NetworkWorkload(Workload):
+    """ allocate/deallocate in a user's private network, as _save does """
+    def setup(self):
+        self.keeper = datastore.keeper(prefix='net')
+        with self.keeper.transaction():
+            for vlan, user_id in enumerate(self.users):
+                hosts = {}
+                for idx in xrange(3, 3 + FLAGS.bench_hosts):
+                    address = '10.%d.%d.%d' % (vlan / 256, vlan % 256, idx)
+                    hosts[address] = _host(user_id, address)
+                self.keeper['%s-default' % user_id] = {
+                    'vlan': vlan, 'network': '10.%d.%d.0/24' % (vlan / 256, vlan % 256),
+                    'hosts': hosts, 'external_vpn_ip': '127.0.0.1',
+                    'external_vpn_port': 8000 + vlan}
+            self.keeper['vlans'] = {'start': 0, 'end': len(self.users),
+                                    'vlans': dict((u, i) for i, u in
+                                                  enumerate(self.users))}
+
+    def op(self):
+        user_id = self.rng.choice(self.users)
+        with self.keeper.transaction():
+            net = copy.deepcopy(self.keeper['%s-default' % user_id])
+            address = self.rng.choice(net['hosts'].keys())
+            if self.rng.random() < 0.5:
+                del net['hosts'][address]
+            else:
+                net['hosts'][address] = _host(user_id, address)
+            self.keeper['%s-default' % user_id] = net
+            self.keeper['vlans'] = self.keeper['vlans']
+
+
+class PublicWorkload(Workload):
+    """ describe_addresses reads vs associate/disassociate writes """
+    def setup(self):
+        self.keeper = datastore.keeper(prefix='net')
+        hosts = {}
+        for idx in xrange(FLAGS.bench_addresses):
+            address = '172.%d.%d.%d' % (idx / 65536, idx / 256 % 256, idx % 256)
+            hosts[address] = _host(self.rng.choice(self.users), address)
+        self.addresses = hosts.keys()
+        self.keeper['public'] = {'vlan': 2000, 'network': '172.0.0.0/12',
+                                 'hosts': hosts}
+
+    def op(self):
+        public = self.keeper['public']
+        if self.rng.random() < 0.9:
+            return
+        public = copy.deepcopy(public)
+        host = public['hosts'][self.rng.choice(self.addresses)]
+        if 'private_ip' in host:
+            del host['private_ip']
+            del host['instance_id']
+        else:
+            host['private_ip'] = '10.0.0.3'
+            host['instance_id'] = 'i-%06d' % self.rng.randint(0, 999999)
+        self.keeper['public'] = public
+
+
+class VpnPortsWorkload(Workload):
+    """ User.vpn_port: read the whole port map on every lookup """
+    def setup(self):
+        self.keeper = datastore.keeper(prefix='user')
+        self.keeper['vpn_ports'] = dict((u, 8000 + i) for i, u in
+                                        enumerate(self.users))
+
+    def op(self):
+        port_map = self.keeper['vpn_ports']
+        if self.rng.random() < 0.01:
+            port_map = copy.deepcopy(port_map)
+            port_map['new%d' % len(port_map)] = max(port_map.values()) + 1
+        self.keeper['vpn_ports'] = port_map
+
+
+class VolumesWorkload(Workload):
+    """ Volume.load on every getter plus occasional attach/detach saves """
+    def setup(self):
+        self.keeper = datastore.keeper(prefix='storage')
+        self.volumes = ['vol-%08d' % i for i in xrange(FLAGS.bench_users * 2)]
+        with self.keeper.transaction():
+            for volume_id in self.volumes:
+                self.keeper[volume_id] = {
+                    'user_id': self.rng.choice(self.users), 'status': 'available',
+                    'size': 10, 'mountpoint': None, 'instance_id': None,
+                    'aoe_device': 'e1.1'}
+
+    def op(self):
+        volume_id = self.rng.choice(self.volumes)
+        for i in xrange(3):
+            state = self.keeper[volume_id]
+        if self.rng.random() < 0.2:
+            state['status'] = (state['status'] == 'attached' and 'available'
+                               or 'attached')
+            self.keeper[volume_id] = state
+
+
+class LdapWorkload(Workload):
+    """ fakeldap: authenticate by access key, sometimes add a key pair """
+    def setup(self):
+        self.keeper = datastore.keeper(prefix='fakeldap')
+        self.keeper.add_index('accessKey')
+        with self.keeper.transaction():
+            for user_id in self.users:
+                self.keeper['dc=com,dc=example,ou=Users,uid=%s' % user_id] = {
+                    'objectclass': ['person', 'novaUser'], 'uid': [user_id],
+                    'accessKey': ['%s-access' % user_id],
+                    'secretKey': ['%s-secret' % user_id], 'isAdmin': ['FALSE']}
+        self.keys = 0
+
+    def op(self):
+        user_id = self.rng.choice(self.users)
+        self.keeper.find('accessKey', '%s-access' % user_id)
+        if self.rng.random() < 0.05:
+            self.keys += 1
+            self.keeper['dc=com,dc=example,ou=Users,uid=%s,cn=key%d' %
+                        (user_id, self.keys)] = {
+                'objectclass': ['novaKeyPair'], 'cn': ['key%d' % self.keys],
+                'sshPublicKey': ['ssh-rsa AAAA'], 'keyFingerprint': ['00:11']}
+
+
+WORKLOADS = {'network': NetworkWorkload,
+             'public': PublicWorkload,
+             'vpn_ports': VpnPortsWorkload,
+             'volumes': VolumesWorkload,
+             'ldap': LdapWorkload}
+
+
+def _count_bytes(backend, counter):
+    commit = backend.commit
+    def _commit(writes):
+        for data in writes.itervalues():
+            if data is not datastore._DELETED:
+                counter[0] += len(data)
+        return commit(writes)
+    backend.commit = _commit
+
+
+def _percentile(samples, pct):
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100.0))]
+
+
+def run(name, backend, format, cache_size):
+    """ Run one workload in a scratch datastore and return its stats. """
+    path = tempfile.mkdtemp(prefix='keeper-bench-')
+    FLAGS.datastore_path = path
+    FLAGS.datastore_backend = backend
+    FLAGS.datastore_format = format
+    FLAGS.datastore_cache_size = cache_size
+    datastore._cache.clear()
+    try:
+        workload = WORKLOADS[name](random.Random(42))
+        workload.setup()
+        written = [0]
+        _count_bytes(datastore._get_backend(), written)
+        samples = []
+        start = time.time()
+        for i in xrange(FLAGS.bench_ops):
+            t = time.time()
+            workload.op()
+            samples.append(time.time() - t)
+        elapsed = time.time() - start
+    finally:
+        datastore._backends.pop((backend, path), None)
+        shutil.rmtree(path, ignore_errors=True)
+    samples.sort()
+    return {'ops': FLAGS.bench_ops / elapsed,
+            'p50': _percentile(samples, 50) * 1000,
+            'p99': _percentile(samples, 99) * 1000,
+            'bytes': written[0] / float(FLAGS.bench_ops)}
+
+
+def main(argv):
+    print ('%-10s %-5s %-8s %6s %10s %9s %9s %12s' %
+           ('workload', 'store', 'format', 'cache', 'ops/sec', 'p50 ms',
+            'p99 ms', 'bytes/op'))
+    for name in FLAGS.bench_workloads:
+        for backend in FLAGS.bench_backends:
+            for format in FLAGS.bench_formats:
+                for cache_size in FLAGS.bench_cache_sizes:
+                    stats = run(name, backend, format, int(cache_size))
+                    print ('%-10s %-5s %-8s %6s %10.1f %9.3f %9.3f %12.1f' %
+                           (name, backend, format, cache_size, stats['ops'],
+                            stats['p50'], stats['p99'], stats['bytes']))
+                    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(FLAGS(sys.argv))
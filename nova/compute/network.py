@@ -1,8 +1,14 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
+import collections
+import copy
 import logging
 import os
+import socket
+import struct
 import subprocess
 import signal
+import sys
+import time
 
 # TODO(termie): clean up these imports
 from nova import datastore, exception, contrib
@@ -17,6 +23,7 @@ from nova import flags
 import anyjson
 import IPy
 from IPy import IP
+from tornado import ioloop
 from twisted.internet import defer
 from nova.auth.users import UserManager
 
@@ -37,6 +44,8 @@ flags.DEFINE_string('public_range', '198.10.124.128-198.10.124.191', 'Public IP
 flags.DEFINE_string('private_range', '10.128.0.0/12', 'Private IP address block')
 flags.DEFINE_string('cloudpipe_ami', 'ami-A7370FE3', 'CloudPipe image')
 flags.DEFINE_integer('cloudpipe_start_port', 8000, 'Starting port for mapped CloudPipe external ports')
+flags.DEFINE_integer('dhcp_update_delay', 200,
+                     'milliseconds to batch dnsmasq host changes for (0 to write them at once)')
 
 KEEPER = datastore.keeper(prefix="net")
 
@@ -50,13 +59,166 @@ logging.getLogger().setLevel(logging.DEBUG)
 
 
 
+class IptablesManager(object):
+    """
+    Keeps the rules this process wants in chains of its own (for
+    nova-compute: nova-compute-forward, nova-compute-prerouting, ...),
+    jumped to from the top of the builtin chains, and applies whatever
+    changed since the last apply() with one iptables-restore --noflush,
+    which replaces those chains atomically.  Other nova processes on the
+    host keep theirs in their own chains, so they can't clobber ours.
+
+    The first time it touches a table it reads the running ruleset once:
+    chains of ours left by an earlier run are rewritten too, and rules
+    that older releases inserted straight into the builtin chains are
+    deleted as we take them over.
+    """
+    # the kernel's limit on chain names
+    _MAX_CHAIN = 28
+    _BUILTIN = ('INPUT', 'OUTPUT', 'FORWARD', 'PREROUTING', 'POSTROUTING')
+
+    def __init__(self, prefix=None):
+        if prefix is None:
+            prefix = os.path.basename(sys.argv[0]).split('.')[0]
+            if not prefix.startswith('nova-'):
+                prefix = 'nova-%s' % prefix
+        self.prefix = prefix
+        self.rules = {}
+        self.applied = {}
+        self.hooked = set()
+        self.legacy = {}
+        self.seen = set()
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, '_instance'):
+            cls._instance = cls()
+        return cls._instance
+
+    def _parse(self, cmd):
+        """ "PREROUTING -t nat -d ..." -> ('nat', 'PREROUTING', '-d ...') """
+        args = cmd.split()
+        chain = args.pop(0)
+        table = 'filter'
+        if '-t' in args:
+            idx = args.index('-t')
+            table = args[idx + 1]
+            del args[idx:idx + 2]
+        return (table, chain, " ".join(args))
+
+    def _chain(self, chain):
+        chain = chain.lower()
+        return "%s-%s" % (self.prefix[:self._MAX_CHAIN - len(chain) - 1],
+                          chain)
+
+    def add_rule(self, cmd):
+        table, chain, rule = self._parse(cmd)
+        rules = self.rules.setdefault((table, chain),
+                                      collections.OrderedDict())
+        rules[rule] = True
+
+    def remove_rule(self, cmd):
+        table, chain, rule = self._parse(cmd)
+        self.rules.get((table, chain), {}).pop(rule, None)
+
+    def _read(self, table):
+        """ Note which of our chains are hooked or left over from an
+        earlier run, and what else is in the builtin chains, from the
+        running ruleset """
+        self.seen.add(table)
+        current = execute("sudo iptables-save -t %s" % table)[0] or ''
+        ours = dict((self._chain(chain), chain) for chain in self._BUILTIN)
+        for line in current.splitlines():
+            args = line.split()
+            if len(args) < 2:
+                continue
+            if args[0].startswith(':') and args[0][1:] in ours:
+                # a chain of ours from an earlier run, rewrite it
+                chain = ours[args[0][1:]]
+                self.rules.setdefault((table, chain),
+                                      collections.OrderedDict())
+                self.applied[(table, chain)] = None
+            elif args[0] == '-A' and args[1] in self._BUILTIN:
+                if args[2:] == ['-j', self._chain(args[1])]:
+                    self.hooked.add((table, args[1]))
+                else:
+                    self.legacy.setdefault((table, args[1]), []).append(
+                            " ".join(args[2:]))
+
+    def _is_legacy(self, saved, rule):
+        """ Whether saved, a rule as iptables-save prints it, is rule.
+
+        iptables-save spells rules its own way (-d 10.0.0.3/32, -m tcp,
+        --to-destination), so compare the addresses, ports and target.
+        """
+        saved = saved.replace('/32', '').split()
+        args = rule.split()
+        for opt, alias in (('-j', '-j'), ('-p', '-p'), ('--dport', '--dport'),
+                           ('--in-interface', '-i')):
+            if opt in args:
+                value = args[args.index(opt) + 1]
+                if not alias in saved or \
+                        saved[saved.index(alias) + 1] != value:
+                    return False
+        addresses = lambda args: set(arg for arg in args
+                                     if arg[0].isdigit() and '.' in arg)
+        return addresses(saved) == addresses(args)
+
+    def _take_over(self, table, chain):
+        """ Delete the builtin chain's copies of rules now in ours """
+        legacy = self.legacy.get((table, chain))
+        if not legacy:
+            return
+        for rule in self.rules[(table, chain)]:
+            for saved in legacy:
+                if self._is_legacy(saved, rule):
+                    legacy.remove(saved)
+                    execute("sudo iptables -t %s --delete %s %s" %
+                            (table, chain, rule))
+                    break
+
+    def apply(self):
+        if FLAGS.fake_network:
+            return
+        for table in set(table for table, chain in self.rules):
+            if not table in self.seen:
+                self._read(table)
+        changed = [key for key, rules in self.rules.iteritems()
+                   if rules.keys() != self.applied.get(key)]
+        if not changed:
+            return
+        tables = {}
+        for table, chain in changed:
+            tables.setdefault(table, []).append(chain)
+        lines = []
+        for table, chains in sorted(tables.iteritems()):
+            lines.append("*%s" % table)
+            for chain in chains:
+                lines.append(":%s - [0:0]" % self._chain(chain))
+            for chain in chains:
+                if not (table, chain) in self.hooked:
+                    lines.append("-I %s -j %s" % (chain, self._chain(chain)))
+                    self.hooked.add((table, chain))
+            for chain in chains:
+                for rule in self.rules[(table, chain)]:
+                    lines.append("-A %s %s" % (self._chain(chain), rule))
+            lines.append("COMMIT")
+        logging.debug("Applying %d iptables chains" % len(changed))
+        execute("sudo iptables-restore --noflush", input="\n".join(lines) + "\n")
+        for key in changed:
+            self.applied[key] = self.rules[key].keys()
+            self._take_over(*key)
+
+
 def confirm_rule(cmd):
-    execute("sudo iptables --delete %s" % (cmd))
-    execute("sudo iptables -I %s" % (cmd))
+    rules = IptablesManager.instance()
+    rules.add_rule(cmd)
+    rules.apply()
 
 def remove_rule(cmd):
-    execute("sudo iptables --delete %s" % (cmd))
-    pass
+    rules = IptablesManager.instance()
+    rules.remove_rule(cmd)
+    rules.apply()
 
 class Network(object):
     def __init__(self, *args, **kwargs):
@@ -76,6 +238,36 @@ class Network(object):
         except Exception, err:
             pass
         self.hosts = kwargs.get('hosts', {})
+        self._index_hosts()
+        # set when hosts change, cleared once NetworkController saves us
+        self.dirty = False
+
+    def _offset(self, address):
+        return struct.unpack('>I', socket.inet_aton(address))[0] - self._base
+
+    def _address(self, offset):
+        return socket.inet_ntoa(struct.pack('>I', self._base + offset))
+
+    def _allocatable(self, offset):
+        # the .2 address is always CloudPipe
+        return 3 <= offset < len(self._allocated) - 2
+
+    def _index_hosts(self):
+        """ Rebuild the allocation bitmap and free list from self.hosts """
+        self._base = self.network.int()
+        self._allocated = bytearray(len(self.network))
+        for address in self.hosts:
+            offset = self._offset(address)
+            if 0 <= offset < len(self._allocated):
+                self._allocated[offset] = 1
+        self._free = collections.deque(
+                offset for offset in xrange(3, len(self._allocated) - 2)
+                if not self._allocated[offset])
+
+    def is_allocated(self, address):
+        offset = self._offset(address)
+        return (0 <= offset < len(self._allocated) and
+                bool(self._allocated[offset]))
     
     def to_dict(self):
         return {'vlan': self.vlan,
@@ -108,21 +300,32 @@ class Network(object):
             yield self.network[idx]
     
     def allocate_ip(self, user_id, mac):
-        for ip in self.range():
-            address = str(ip)
-            if not address in self.hosts.keys():
-                logging.debug("Allocating IP %s to %s" % (address, user_id))
-                self.hosts[address] = {
-                    "address" : address, "user_id" : user_id, 'mac' : mac
-                }
-                self.express(address=address)
-                return address
+        while self._free:
+            offset = self._free.popleft()
+            if self._allocated[offset]:
+                continue
+            address = self._address(offset)
+            logging.debug("Allocating IP %s to %s" % (address, user_id))
+            self._allocated[offset] = 1
+            self.hosts[address] = {
+                "address" : address, "user_id" : user_id, 'mac' : mac
+            }
+            self.dirty = True
+            self.express(address=address)
+            return address
         raise NoMoreAddresses()
     
     def deallocate_ip(self, ip_str):
-        if not ip_str in self.hosts.keys():
+        if not ip_str in self.hosts:
             raise AddressNotAllocated()
         del self.hosts[ip_str]
+        self.dirty = True
+        offset = self._offset(ip_str)
+        if 0 <= offset < len(self._allocated):
+            self._allocated[offset] = 0
+        if self._allocatable(offset):
+            # to the back, so addresses are reused longest-free first
+            self._free.append(offset)
         # TODO(joshua) SCRUB from the leases file somehow
         self.deexpress(address=ip_str)
     
@@ -191,6 +394,7 @@ class DHCPNetwork(VirtNetwork):
         super(DHCPNetwork, self).__init__(*args, **kwargs)
         logging.debug("Initing DHCPNetwork object...")
         self.bridge_gets_ip = True
+        self._dhcp_timeout = None
     
     def hostDHCP(self, host):
         idx = host['address'].split(".")[-1] # Logically, the idx of instances they've launched in this net
@@ -206,9 +410,13 @@ class DHCPNetwork(VirtNetwork):
     
     def start_dnsmasq(self):
         conf_file = "%s/nova-%s.conf" % (FLAGS.networks_path, self.vlan)
-        conf = open(conf_file, "w")
+        # dnsmasq may reread the file at any time, so never let it see
+        # a partly written one
+        tmp_file = "%s.tmp" % conf_file
+        conf = open(tmp_file, "w")
         conf.write("\n".join(map(self.hostDHCP, self.hosts.values())))
         conf.close()
+        os.rename(tmp_file, conf_file)
         
         pid_file = "%s/nova-%s.pid" % (FLAGS.networks_path, self.vlan)
         if os.path.exists(pid_file):
@@ -224,13 +432,40 @@ class DHCPNetwork(VirtNetwork):
         cmd = self.dnsmasq_cmd(conf_file)
         subprocess.Popen(str(cmd).split(" "))
     
+    def update_dhcp(self):
+        """ Rewrite the hosts file and reload dnsmasq once the current
+        batch of changes is in, rather than once per change """
+        io_inst = ioloop.IOLoop.instance()
+        if FLAGS.dhcp_update_delay <= 0 or not io_inst.running():
+            # with no loop running (nova-manage, say) nothing would flush it
+            return self._flush_dhcp()
+        if self._dhcp_timeout is None:
+            self._dhcp_timeout = io_inst.add_timeout(
+                    time.time() + FLAGS.dhcp_update_delay / 1000.0,
+                    self._flush_dhcp)
+
+    def _cancel_dhcp(self):
+        timeout, self._dhcp_timeout = self._dhcp_timeout, None
+        if timeout is None:
+            return
+        try:
+            ioloop.IOLoop.instance().remove_timeout(timeout)
+        except ValueError:
+            # the loop already dropped it
+            pass
+
+    def _flush_dhcp(self):
+        self._dhcp_timeout = None
+        if len(self.hosts) > 0:
+            logging.debug("Starting dnsmasq server for network with vlan %s" % self.vlan)
+            self.start_dnsmasq()
+
     def express(self, address=None):
         if FLAGS.fake_network:
             return
         super(DHCPNetwork, self).express(address=address)
         if len(self.hosts.values()) > 0:
-            logging.debug("Starting dnsmasq server for network with vlan %s" % self.vlan)
-            self.start_dnsmasq()     
+            self.update_dhcp()
         else:
             logging.debug("Not launching dnsmasq cause I don't think we have any hosts.")
 
@@ -250,7 +485,10 @@ class DHCPNetwork(VirtNetwork):
         # if this is the last address, stop dns
         super(DHCPNetwork, self).deexpress(address=address)
         if len(self.hosts.values()) == 0:
+            self._cancel_dhcp()
             self.stop_dnsmasq()
+        elif not FLAGS.fake_network:
+            self.update_dhcp()
         
         
 
@@ -259,7 +497,6 @@ class PrivateNetwork(DHCPNetwork):
         self.external_vpn_ip = external_vpn_ip
         self.external_vpn_port = external_vpn_port
         super(PrivateNetwork, self).__init__(conn=conn, **kwargs)
-        self.express()
 
     def to_dict(self):
         return {'vlan': self.vlan,
@@ -274,92 +511,109 @@ class PrivateNetwork(DHCPNetwork):
         
     def get_vpn_ip(self, user_id, mac):
         address = str(self.network[2])
+        self._allocated[2] = 1
         self.hosts[address] = {
                     "address" : address, "user_id" : user_id, 'mac' : mac
         }
+        self.dirty = True
         self.express()
         return address
 
     def cloudpipe_express(self):
         # TODO: Test and see if the rule is in place
         private_ip = self.network[2]
-        confirm_rule("FORWARD -d %s -p udp --dport 1194 -j ACCEPT" % (private_ip, ))
-        confirm_rule("PREROUTING -t nat -d %s -p udp --dport %s -j DNAT --to %s:1194" % (self.external_vpn_ip, self.external_vpn_port, private_ip))
+        rules = IptablesManager.instance()
+        rules.add_rule("FORWARD -d %s -p udp --dport 1194 -j ACCEPT" % (private_ip, ))
+        rules.add_rule("PREROUTING -t nat -d %s -p udp --dport %s -j DNAT --to %s:1194" % (self.external_vpn_ip, self.external_vpn_port, private_ip))
+        rules.apply()
     
         
 class PublicNetwork(Network):
     def __init__(self, conn=None, network="192.168.216.0/24", **kwargs):
         super(PublicNetwork, self).__init__(network=network, conn=conn, **kwargs)
-        self.express()
 
-    def allocate_ip(self, user_id, mac):
-        for ip in self.range():
-            address = str(ip)
-            if not address in self.hosts.keys():
-                logging.debug("Allocating IP %s to %s" % (address, user_id))
-                self.hosts[address] = {
-                    "address" : address, "user_id" : user_id, 'mac' : mac
-                }
-                self.express(address=address)
-                return address
-        raise NoMoreAddresses()
-    
+    def _index_hosts(self):
+        """ Also rebuild the instance and private ip -> public ip maps """
+        super(PublicNetwork, self)._index_hosts()
+        self._instance_ips = {}
+        self._private_ips = {}
+        for addr in self.hosts.values():
+            if addr.has_key('private_ip'):
+                self._instance_ips[addr['instance_id']] = addr['address']
+                self._private_ips[addr['private_ip']] = addr['address']
+
+    def public_ip_for_instance(self, instance_id):
+        return self._instance_ips.get(instance_id)
+
     def deallocate_ip(self, ip_str):
-        if not ip_str in self.hosts:
-            raise AddressNotAllocated()
-        del self.hosts[ip_str]
-        # TODO(joshua) SCRUB from the leases file somehow
-        self.deexpress(address=ip_str)
+        if ip_str in self.hosts and self.hosts[ip_str].has_key('private_ip'):
+            self.disassociate_address(ip_str)
+        super(PublicNetwork, self).deallocate_ip(ip_str)
 
     def associate_address(self, public_ip, private_ip, instance_id):
         if not public_ip in self.hosts:
             raise AddressNotAllocated()
-        for addr in self.hosts.values():
-            if addr.has_key('private_ip') and addr['private_ip'] == private_ip:
-                raise AddressAlreadyAssociated()
+        if private_ip in self._private_ips:
+            raise AddressAlreadyAssociated()
         if self.hosts[public_ip].has_key('private_ip'):
             raise AddressAlreadyAssociated()
         self.hosts[public_ip]['private_ip'] = private_ip
         self.hosts[public_ip]['instance_id'] = instance_id
+        self._instance_ips[instance_id] = public_ip
+        self._private_ips[private_ip] = public_ip
+        self.dirty = True
         self.express(address=public_ip)
 
     def disassociate_address(self, public_ip):
         if not public_ip in self.hosts:
             raise AddressNotAllocated()
-        if not self.hosts[public_ip].has_key('private_ip'):
+        addr = self.hosts[public_ip]
+        if not addr.has_key('private_ip'):
             raise AddressNotAssociated()
-        self.deexpress(self.hosts[public_ip])
-        del self.hosts[public_ip]['private_ip']
-        del self.hosts[public_ip]['instance_id']
-        # TODO Express the removal
+        self.deexpress(address=public_ip)
+        self._instance_ips.pop(addr['instance_id'], None)
+        self._private_ips.pop(addr['private_ip'], None)
+        del addr['private_ip']
+        del addr['instance_id']
+        self.dirty = True
     
     def deexpress(self, address):
-        addr = self.hosts[address]
+        if FLAGS.fake_network:
+            return
+        addr = self.hosts.get(address)
+        if not addr or not addr.has_key('private_ip'):
+            return
+        rules = IptablesManager.instance()
+        for rule in self._rules(addr):
+            rules.remove_rule(rule)
+        rules.apply()
+
+    def _rules(self, addr):
         public_ip = addr['address']
         private_ip = addr['private_ip']
-        remove_rule("PREROUTING -t nat -d %s -j DNAT --to %s" % (public_ip, private_ip))
-        remove_rule("POSTROUTING -t nat -s %s -j SNAT --to %s" % (private_ip, public_ip))
-        remove_rule("FORWARD -d %s -p icmp -j ACCEPT" % (private_ip))
+        yield "PREROUTING -t nat -d %s -j DNAT --to %s" % (public_ip, private_ip)
+        yield "POSTROUTING -t nat -s %s -j SNAT --to %s" % (private_ip, public_ip)
+        # TODO: Get these from the secgroup datastore entries
+        yield "FORWARD -d %s -p icmp -j ACCEPT" % (private_ip)
         for (protocol, port) in [("tcp",80), ("tcp",22), ("udp",1194), ("tcp",443)]:
-            remove_rule("FORWARD -d %s -p %s --dport %s -j ACCEPT" % (private_ip, protocol, port))
+            yield "FORWARD -d %s -p %s --dport %s -j ACCEPT" % (private_ip, protocol, port)
 
     def express(self, address=None):
+        if FLAGS.fake_network:
+            return
         logging.debug("Todo - need to create IPTables natting entries for this net.")
         addresses = self.hosts.values()
         if address:
             addresses = [self.hosts[address]]
+        rules = IptablesManager.instance()
         for addr in addresses:
             if not addr.has_key('private_ip'):
                 continue
             public_ip = addr['address']
-            private_ip = addr['private_ip']
             runthis("Binding IP to interface: %s", "sudo ip addr add %s dev %s" % (public_ip, FLAGS.public_interface))
-            confirm_rule("PREROUTING -t nat -d %s -j DNAT --to %s" % (public_ip, private_ip))
-            confirm_rule("POSTROUTING -t nat -s %s -j SNAT --to %s" % (private_ip, public_ip))
-            # TODO: Get these from the secgroup datastore entries
-            confirm_rule("FORWARD -d %s -p icmp -j ACCEPT" % (private_ip))
-            for (protocol, port) in [("tcp",80), ("tcp",22), ("udp",1194), ("tcp",443)]:
-                confirm_rule("FORWARD -d %s -p %s --dport %s -j ACCEPT" % (private_ip, protocol, port))
+            for rule in self._rules(addr):
+                rules.add_rule(rule)
+        rules.apply()
 
 
 class NetworkPool(object):
@@ -378,15 +632,27 @@ class NetworkPool(object):
         logging.debug("Allocating %s" % net_str)
         return net_str
 
+    def get_vlan(self, address):
+        """ The vlan whose subnet holds address, or None """
+        offset = IP(address).int() - self.network.int()
+        if offset < 0 or offset >= len(self.network):
+            return None
+        return self.startvlan + offset / self.netsize
+
 class VlanPool(object):
     def __init__(self, **kwargs):
         self.start = kwargs.get('start', FLAGS.vlan_start)
         self.end = kwargs.get('end', FLAGS.vlan_end)
         self.vlans = kwargs.get('vlans', {})
         self.vlanpool = {}
-        self.manager = UserManager()
+        self.dirty = False
         for user_id, vlan in self.vlans.iteritems():
             self.vlanpool[vlan] = user_id
+        # vlans run from start + 1 up to, but not including, end, as they
+        # always have; existing users' subnets are derived from them
+        self._free = collections.deque(
+                vlan for vlan in xrange(self.start + 1, self.end)
+                if not vlan in self.vlanpool)
     
     def to_dict(self):
         return {'vlans': self.vlans,
@@ -414,21 +680,25 @@ class VlanPool(object):
         return cls.from_dict(parsed, conn=conn)
     
     def next(self, user_id):
-        def assign_vlan(user_id, vlan):
-            self.vlans[user_id] = vlan
-            self.vlanpool[vlan] = user_id
+        if user_id in self.vlans:
             return self.vlans[user_id]
-        for old_user_id, vlan in self.vlans.iteritems():
-            if not self.manager.get_user(old_user_id):
-                KEEPER["%s-default" % old_user_id] = {}
-                del KEEPER["%s-default" % old_user_id] 
-                return assign_vlan(user_id, vlan)
-        vlans = self.vlanpool.keys()
-        vlans.append(self.start)
-        nextvlan = max(vlans) + 1
-        if nextvlan == self.end:
+        if not self._free:
             raise AddressNotAllocated("Out of VLANs")
-        return assign_vlan(user_id, nextvlan)
+        vlan = self._free.popleft()
+        self.vlans[user_id] = vlan
+        self.vlanpool[vlan] = user_id
+        self.dirty = True
+        return vlan
+
+    def release(self, user_id):
+        """ Return a user's vlan to the pool """
+        vlan = self.vlans.pop(user_id, None)
+        if vlan is None:
+            return
+        del self.vlanpool[vlan]
+        # reuse the longest-free vlans first
+        self._free.append(vlan)
+        self.dirty = True
 
 class NetworkController(GenericNode):
     """ The network controller is in charge of network connections  """
@@ -442,17 +712,20 @@ class NetworkController(GenericNode):
         if not KEEPER['vlans']:
             KEEPER['vlans'] = {'start' : FLAGS.vlan_start, 'end' : FLAGS.vlan_end}
         vlan_dict = kwargs.get('vlans', KEEPER['vlans'])
-        self.vlan_pool = VlanPool.from_dict(vlan_dict)
+        self.vlan_pool = VlanPool.from_dict(copy.deepcopy(vlan_dict))
         self.private_pool = kwargs.get('private_pool', NetworkPool(netsize=self.netsize, startvlan=KEEPER['vlans']['start'], network=FLAGS.private_range))
         self.private_nets = kwargs.get('private_nets', {})
         if not KEEPER['private']:
             KEEPER['private'] = {'networks' :[]}
-        for net in KEEPER['private']['networks']:
-            if self.manager.get_user(net['user_id']):
-                self.get_users_network(net['user_id'])
+        self._private = dict((net['user_id'], net)
+                             for net in KEEPER['private']['networks'])
+        self._private_dirty = False
+        # networks are loaded on first use, and brought up by
+        # express_networks() rather than here, so startup doesn't scale
+        # with the number of users
         if not KEEPER['public']:
             KEEPER['public'] = kwargs.get('public', {'vlan': FLAGS.public_vlan, 'network' : FLAGS.public_range })
-        self.public_net = PublicNetwork.from_dict(KEEPER['public'], conn=self._conn)
+        self.public_net = PublicNetwork.from_dict(copy.deepcopy(KEEPER['public']), conn=self._conn)
 
     def reset(self):
         KEEPER['public'] = {'vlan': FLAGS.public_vlan, 'network': FLAGS.public_range }
@@ -464,32 +737,44 @@ class NetworkController(GenericNode):
         net_dict = KEEPER[network_name]
         if net_dict:
             #network_str = self.private_pool.next() # TODO, block allocations
-            return PrivateNetwork.from_dict(net_dict)
+            return PrivateNetwork.from_dict(copy.deepcopy(net_dict))
         return None
         
     def get_public_ip_for_instance(self, instance_id):
-        # FIXME: this should be a lookup - iteration won't scale
-        for address_record in self.describe_addresses(type=PublicNetwork):
-            if address_record.get(u'instance_id', 'free') == instance_id:
-                return address_record[u'address']
+        return self.public_net.public_ip_for_instance(instance_id)
+
+    def _get_network(self, user_id):
+        """ The user's saved network, loaded from the keeper on first use """
+        if not user_id in self.private_nets:
+            usernet = self.get_network_from_name("%s-default" % user_id)
+            if not usernet:
+                return None
+            self.private_nets[user_id] = usernet
+        return self.private_nets[user_id]
 
     def get_users_network(self, user_id):
+        usernet = self._get_network(user_id)
+        if usernet:
+            return usernet
         user = self.manager.get_user(user_id)
         if not user:
            raise Exception("User %s doesn't exist, uhoh." % user_id)
-        #if not self.private_nets.has_key(user_id):
-        usernet = self.get_network_from_name("%s-default" % user_id)
-        if not usernet:
-            vlan = self.vlan_pool.next(user_id)
-            network_str = self.private_pool.get_from_vlan(vlan)
-            # logging.debug("Constructing network %s and %s for %s" % (network_str, vlan, user_id))
-            usernet = PrivateNetwork(
-                external_vpn_ip = user.vpn_ip,
-                external_vpn_port = user.vpn_port,
-                network = network_str,
-                vlan = self.vlan_pool.vlans[user_id],
-                conn = self._conn)
-            KEEPER["%s-default" % user_id] = usernet.to_dict()
+        vlan = self.vlan_pool.next(user_id)
+        network_str = self.private_pool.get_from_vlan(vlan)
+        # logging.debug("Constructing network %s and %s for %s" % (network_str, vlan, user_id))
+        usernet = PrivateNetwork(
+            external_vpn_ip = user.vpn_ip,
+            external_vpn_port = user.vpn_port,
+            network = network_str,
+            vlan = self.vlan_pool.vlans[user_id],
+            conn = self._conn)
+        usernet.express()
+        KEEPER["%s-default" % user_id] = usernet.to_dict()
+        if not user_id in self._private:
+            self._private[user_id] = {'user_id': user_id,
+                                      'network': usernet.network_str,
+                                      'vlan': usernet.vlan}
+            self._private_dirty = True
         self.private_nets[user_id] = usernet
         return self.private_nets[user_id]
 
@@ -517,11 +802,12 @@ class NetworkController(GenericNode):
             rv = self.public_net.deallocate_ip(address)
             self._save()
             return rv
-        for user_id in self.private_nets.keys(): 
-            if not self.manager.get_user(user_id):
-                continue
-            if address in self.get_users_network(user_id).network:
-                rv = self.get_users_network(user_id).deallocate_ip(address)
+        vlan = self.private_pool.get_vlan(address)
+        user_id = self.vlan_pool.vlanpool.get(vlan)
+        if user_id:
+            net = self._get_network(user_id)
+            if net and address in net.network:
+                rv = net.deallocate_ip(address)
                 self._save()
                 return rv
         raise AddressNotAllocated()
@@ -529,8 +815,10 @@ class NetworkController(GenericNode):
     def describe_addresses(self, type=PrivateNetwork):
         if type == PrivateNetwork:
             addresses = []
-            for user_id in self.private_nets.keys(): 
-                addresses.extend(self.get_users_network(user_id).list_addresses())
+            for user_id in self._private.keys(): 
+                net = self._get_network(user_id)
+                if net:
+                    addresses.extend(net.list_addresses())
             return addresses
         return self.public_net.list_addresses()
         
@@ -545,23 +833,69 @@ class NetworkController(GenericNode):
         return rv
         
     def _save(self):
+        """ Write out only the networks and pools that changed """
         logging.debug("saving data")
-        obj = {}
-        obj['networks'] = []
-        for user_id in self.private_nets.keys():
+        with KEEPER.transaction():
+            for user_id, network in self.private_nets.iteritems():
+                if network.dirty:
+                    KEEPER["%s-default" % user_id] = network.to_dict()
+                    network.dirty = False
+            if self._private_dirty:
+                KEEPER['private'] = {'networks': self._private.values()}
+                self._private_dirty = False
+            if self.public_net.dirty:
+                KEEPER['public'] = self.public_net.to_dict()
+                self.public_net.dirty = False
+            if self.vlan_pool.dirty:
+                KEEPER['vlans'] = self.vlan_pool.to_dict()
+                self.vlan_pool.dirty = False
+
+    def _release(self, user_id):
+        logging.debug("Releasing network for deleted user %s" % user_id)
+        self.private_nets.pop(user_id, None)
+        if self._private.pop(user_id, None):
+            self._private_dirty = True
+        if KEEPER["%s-default" % user_id]:
+            del KEEPER["%s-default" % user_id]
+        self.vlan_pool.release(user_id)
+
+    def release_user(self, user_id):
+        """ Drop a deleted user's network and give its vlan back """
+        self._release(user_id)
+        self._save()
+
+    def reconcile_users(self):
+        """ Release the networks of deleted users we weren't told about """
+        for user_id in set(self._private.keys() + self.vlan_pool.vlans.keys()):
             if not self.manager.get_user(user_id):
-                continue
-            network = self.private_nets[user_id]
-            #logging.debug("found private net")
-            vlan = self.vlan_pool.vlans[user_id]
-            obj['networks'].append({'user_id': user_id, 
-                                    'network': str(network), 
-                                    'vlan': vlan })
-            KEEPER["%s-default" % user_id] = self.private_nets[user_id].to_dict()
-        # logging.debug("done private net loop")
-        KEEPER['private'] = obj
-        KEEPER['public'] = self.public_net.to_dict()
-        KEEPER['vlans'] = self.vlan_pool.to_dict()
+                self._release(user_id)
+        self._save()
+
+    def express_networks(self):
+        """
+        Bring up the interfaces, dnsmasq and rules of every saved network,
+        one network per IOLoop iteration so requests are served meanwhile.
+        Returns a Deferred that fires once all of them are up.
+        """
+        d = defer.Deferred()
+        io_inst = ioloop.IOLoop.instance()
+        user_ids = self._private.keys()
+        def _next():
+            if not user_ids:
+                self.public_net.express()
+                d.callback(None)
+                return
+            user_id = user_ids.pop()
+            try:
+                if self.manager.get_user(user_id):
+                    net = self._get_network(user_id)
+                    if net:
+                        net.express()
+            except Exception:
+                logging.exception("Failed to express network for %s" % user_id)
+            io_inst.add_callback(_next)
+        io_inst.add_callback(_next)
+        return d
 
     def express(self,address=None):
         return
@@ -1,6 +1,20 @@
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import logging
+import marshal
 import os
+import struct
+import threading
+import urllib
+import zlib
 import contrib
 import anyjson
+from tornado import ioloop
 
 import flags
 import utils
@@ -9,38 +23,880 @@ FLAGS = flags.FLAGS
 
 flags.DEFINE_string('datastore_path', utils.abspath('../keeper'),
                     'where keys are stored on disk')
+flags.DEFINE_integer('datastore_cache_size', 512,
+                     'number of deserialized keeper values to keep in '
+                     'memory (0 to disable caching)')
+flags.DEFINE_string('datastore_backend', 'file',
+                    'how keeper stores keys: file (one file per key) or '
+                    'log (single append-only record log)')
+flags.DEFINE_integer('datastore_log_compact_size', 4 * 1024 * 1024,
+                     'minimum log size in bytes before the log backend '
+                     'considers compacting')
+flags.DEFINE_string('datastore_format', 'json',
+                    'how keeper encodes values it writes: json or marshal '
+                    '(both are always readable)')
+flags.DEFINE_integer('datastore_compress_size', 16 * 1024,
+                     'zlib compress encoded keeper values larger than this '
+                     'many bytes (0 to disable)')
 
 
-class keeper(object):
-    def __init__(self, prefix="nova-"):
-        self.prefix = prefix
+_MISSING = object()
+_DELETED = object()
+
+
+class _FrozenDict(dict):
+    """ A dict that refuses changes, so one value can be shared by the
+    cache and every caller that reads it.  copy.deepcopy() gives back
+    plain, mutable dicts and lists. """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('keeper values are read-only; '
+                        'copy.deepcopy() the value to change it')
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return _thaw(self)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class _FrozenList(list):
+    """ The list counterpart of _FrozenDict """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('keeper values are read-only; '
+                        'copy.deepcopy() the value to change it')
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _readonly
+    __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = reverse = sort = _readonly
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return _thaw(self)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def _freeze(value):
+    """ value with every dict and list replaced by a read-only one """
+    if isinstance(value, (_FrozenDict, _FrozenList)):
+        return value
+    if isinstance(value, dict):
+        return _FrozenDict((k, _freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return _FrozenList(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    """ A plain, mutable deep copy of value """
+    if isinstance(value, dict):
+        return dict((k, _thaw(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [_thaw(v) for v in value]
+    return value
+
+
+# Values written as plain JSON have no header, which keeps them readable
+# by older code.  Anything else starts with the magic, a format version,
+# the codec and a flags byte.
+_MAGIC = '\x00nk'
+_VERSION = '\x01'
+_CODECS = {'json': ('j', anyjson.serialize, anyjson.deserialize),
+           'marshal': ('m', lambda value: marshal.dumps(_as_json(value)),
+                       marshal.loads)}
+_DECODERS = dict((code, loads) for code, dumps, loads in _CODECS.values())
+_COMPRESSED = 0x1
+
+
+def _json_key(key):
+    if isinstance(key, unicode):
+        return key
+    if isinstance(key, str):
+        return key.decode('utf-8')
+    # numbers, None and bools: whatever json makes of them
+    return anyjson.deserialize(anyjson.serialize({key: 0})).keys()[0]
+
+
+def _as_json(value):
+    """ value in the shapes a json round trip gives back: unicode strings
+    and keys and lists for tuples, so reads look the same whichever
+    datastore_format wrote them """
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if isinstance(value, dict):
+        return dict((_json_key(k), _as_json(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_as_json(v) for v in value]
+    if value is None or isinstance(value, (unicode, bool, int, long, float)):
+        return value
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def _encode(value):
+    """ Encode a value with the configured codec.
+
+    marshal is several times faster than json for the big dict-of-dicts
+    values, but its format is tied to the Python major version.
+    """
+    code, dumps, loads = _CODECS[FLAGS.datastore_format]
+    data = dumps(value)
+    bits = 0
+    if FLAGS.datastore_compress_size and len(data) > FLAGS.datastore_compress_size:
+        data = zlib.compress(data, 1)
+        bits |= _COMPRESSED
+    if code == 'j' and not bits:
+        return data
+    return _MAGIC + _VERSION + code + chr(bits) + data
+
+
+def _decode(data):
+    if not data.startswith(_MAGIC):
+        return anyjson.deserialize(data)
+    header = len(_MAGIC) + 3
+    version, code, bits = data[len(_MAGIC):header]
+    if version != _VERSION or code not in _DECODERS:
+        raise ValueError('Unknown keeper value format %r' % data[:header])
+    data = data[header:]
+    if ord(bits) & _COMPRESSED:
+        data = zlib.decompress(data)
+    return _DECODERS[code](data)
+
+
+class _Cache(object):
+    """ LRU of deserialized values.
+
+    Every entry remembers the stamp the backend gave for the key when it
+    was read (inode/mtime/size for files, inode/offset for the log), so a
+    write by another process makes the entry stale rather than wrong.
+    """
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, stamp):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != stamp:
+                return _MISSING
+            self._entries[key] = entry
+        return entry[1]
+
+    def put(self, key, stamp, value):
+        """ value must already be frozen; hits hand it out as is """
+        size = FLAGS.datastore_cache_size
+        if size <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (stamp, value)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = _Cache()
+
+
+def _sync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _FileLock(object):
+    """ An flock on path shared by every process using the store.
+
+    Re-entrant within a thread; other threads in this process wait on
+    lock, which may be one the caller also uses for its own state.
+    """
+    def __init__(self, path, lock=None):
+        self.path = path
+        self._lock = lock or threading.RLock()
+        self._file = None
+        self._depth = 0
+
+    def __enter__(self):
+        self._lock.acquire()
         try:
-            os.mkdir(FLAGS.datastore_path)
+            if not self._depth:
+                lockfile = open(self.path, 'a')
+                try:
+                    fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+                except:
+                    lockfile.close()
+                    raise
+                self._file = lockfile
+            self._depth += 1
         except:
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if not self._depth:
+            lockfile, self._file = self._file, None
+            try:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+            finally:
+                lockfile.close()
+        self._lock.release()
+
+
+class FileBackend(object):
+    """ One file per key under datastore_path. """
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+        self._flock = _FileLock("%s/.keeper.lock" % path)
+
+    def locked(self):
+        """ Hold off other processes' locked() sections, not plain writes """
+        return self._flock
+
+    def _file(self, key):
+        return "%s/%s" % (self.path, key)
+
+    def stamp(self, key):
+        try:
+            st = os.stat(self._file(key))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def read(self, key):
+        try:
+            with open(self._file(key), 'r') as f:
+                return f.read()
+        except IOError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+
+    def keys(self, prefix):
+        return sorted(name for name in os.listdir(self.path)
+                      if name.startswith(prefix) and not name.startswith('.'))
+
+    def changed(self, names):
+        """ Keys touched by the inotify events for names in our directory """
+        return set(name for name in names if not name.startswith('.'))
+
+    def commit(self, writes):
+        """ Replace each key atomically and sync the directory once. """
+        changed = False
+        for key, data in writes.iteritems():
+            path = self._file(key)
+            if data is _DELETED:
+                if os.path.isfile(path):
+                    os.remove(path)
+                    changed = True
+                continue
+            tmp = "%s/.%s.%d.%d.tmp" % (self.path, key, os.getpid(),
+                                        threading.current_thread().ident)
+            with open(tmp, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, path)
+            changed = True
+        if changed:
+            _sync_dir(self.path)
+
+
+class LogBackend(object):
+    """ Every key in a single append-only record log.
+
+    An in-memory index maps each key to the offset of its latest record,
+    so a write is one sequential append (one per transaction) and a read
+    is one seek and read.  Records appended by other processes are picked
+    up by reading the log tail whenever it has grown.  Once the log is
+    mostly dead records it is rewritten in a background thread and
+    renamed over the old one; other processes notice the new inode and
+    re-index.
+
+    Appends and compaction are serialized across processes with flock on
+    a separate lock file, since the log itself is replaced by compaction.
+    """
+    _header = struct.Struct('>cIII')
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(path)
+        except OSError:
             pass
-        
+        self._log = "%s/keeper.log" % path
+        self._lockfile = "%s/keeper.lock" % path
+        self._lock = threading.RLock()
+        self._flock = _FileLock(self._lockfile, self._lock)
+        self._fd = None
+        self._compacting = False
+        # keys appended since changed() was last called, only kept once a
+        # watcher is asking
+        self.watched = False
+        self._changed = set()
+        self._open()
+
+    def _open(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self._log, os.O_RDWR | os.O_CREAT | os.O_APPEND,
+                           0644)
+        self._ino = os.fstat(self._fd).st_ino
+        self._index = {}
+        self._end = 0
+        self._live = 0
+        self._scan()
+
+    def _scan(self):
+        """ Index any complete records past what we have already seen. """
+        size = os.fstat(self._fd).st_size
+        if size <= self._end:
+            return
+        os.lseek(self._fd, self._end, os.SEEK_SET)
+        buf = os.read(self._fd, size - self._end)
+        pos = 0
+        while pos + self._header.size <= len(buf):
+            op, klen, dlen, crc = self._header.unpack_from(buf, pos)
+            start = pos + self._header.size
+            stop = start + klen + dlen
+            if stop > len(buf):
+                # still being written by someone else, or torn by a crash
+                break
+            body = buf[start:stop]
+            if zlib.crc32(body) & 0xffffffff != crc:
+                logging.error("Corrupt keeper log record at %s in %s",
+                              self._end + pos, self._log)
+                break
+            key = body[:klen]
+            self._index_record(key, op, self._end + start + klen, dlen,
+                               stop - pos)
+            if self.watched:
+                self._changed.add(key)
+            pos = stop
+        self._end += pos
+
+    def _index_record(self, key, op, offset, dlen, reclen):
+        old = self._index.pop(key, None)
+        if old:
+            self._live -= old[2]
+        if op == 'P':
+            self._index[key] = (offset, dlen, reclen)
+            self._live += reclen
+
+    def _refresh(self):
+        try:
+            ino = os.stat(self._log).st_ino
+        except OSError:
+            ino = None
+        if ino != self._ino:
+            self._open()
+        else:
+            self._scan()
+
+    def locked(self):
+        """ Hold off other processes' appends and compaction """
+        return self._flock
+
+    def _pack(self, key, data):
+        if data is _DELETED:
+            op, data = 'D', ''
+        else:
+            op = 'P'
+        body = key + data
+        return self._header.pack(op, len(key), len(data),
+                                 zlib.crc32(body) & 0xffffffff) + body
+
+    def stamp(self, key):
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            return (self._ino, entry[0])
+
+    def keys(self, prefix):
+        with self._lock:
+            self._refresh()
+            return sorted(key for key in self._index if key.startswith(prefix))
+
+    def changed(self, names):
+        """ Keys whose records were appended since the last call.
+
+        A log rewritten by compaction is re-indexed from scratch, which
+        reports every key in it.
+        """
+        if os.path.basename(self._log) not in names:
+            return set()
+        with self._lock:
+            self._refresh()
+            changed, self._changed = self._changed, set()
+            return changed
+
+    def read(self, key):
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            os.lseek(self._fd, entry[0], os.SEEK_SET)
+            return os.read(self._fd, entry[1])
+
+    def commit(self, writes):
+        if not writes:
+            return
+        records = [(key, self._pack(key, data))
+                   for key, data in writes.iteritems()]
+        with self.locked():
+            self._refresh()
+            if os.fstat(self._fd).st_size > self._end:
+                logging.warning("Truncating torn tail of %s", self._log)
+                os.ftruncate(self._fd, self._end)
+            os.write(self._fd, ''.join(r for key, r in records))
+            os.fsync(self._fd)
+            offset = self._end
+            for key, record in records:
+                op, klen, dlen, crc = self._header.unpack_from(record)
+                self._index_record(key, op,
+                                   offset + self._header.size + klen,
+                                   dlen, len(record))
+                if self.watched:
+                    self._changed.add(key)
+                offset += len(record)
+            self._end = offset
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        if (self._compacting
+            or self._end < FLAGS.datastore_log_compact_size
+            or self._live * 2 > self._end):
+            return
+        self._compacting = True
+        thread = threading.Thread(target=self._compact)
+        thread.daemon = True
+        thread.start()
+
+    def _compact(self):
+        try:
+            tmp = "%s.compact.%d" % (self._log, os.getpid())
+            with self._lock:
+                ino = self._ino
+                end = self._end
+                live = sorted(self._index.iteritems(),
+                              key=lambda item: item[1][0])
+            # copy the live records without holding up writers
+            src = os.open(self._log, os.O_RDONLY)
+            try:
+                if os.fstat(src).st_ino != ino:
+                    return
+                out = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                              0644)
+                try:
+                    for key, (offset, dlen, reclen) in live:
+                        os.lseek(src, offset, os.SEEK_SET)
+                        os.write(out, self._pack(key, os.read(src, dlen)))
+                    with self.locked():
+                        self._refresh()
+                        if self._ino != ino:
+                            os.unlink(tmp)
+                            return
+                        # whatever was appended meanwhile is copied as is
+                        os.lseek(src, end, os.SEEK_SET)
+                        os.write(out, os.read(src, self._end - end))
+                        os.fsync(out)
+                        os.rename(tmp, self._log)
+                        _sync_dir(self.path)
+                        self._open()
+                finally:
+                    os.close(out)
+            finally:
+                os.close(src)
+        except Exception:
+            logging.exception("Compacting %s failed", self._log)
+        finally:
+            self._compacting = False
+
+
+def _field_values(value, field):
+    if not isinstance(value, dict) or value.get(field) is None:
+        return set()
+    if isinstance(value[field], list):
+        return set(unicode(v) for v in value[field])
+    return set([unicode(value[field])])
+
+
+# An index on field is a marker item _INDEX + field, set once the index
+# has been built, and one item per indexed value listing the items that
+# have it, so a lookup or an update only touches the values involved.
+_INDEX = '__index__'
+
+
+def _index_item(field, value):
+    quoted = urllib.quote(value.encode('utf-8'), safe='')
+    if len(quoted) > 128:
+        # keep file backend names within NAME_MAX
+        quoted = hashlib.sha1(quoted).hexdigest()
+    return '%s%s:%s' % (_INDEX, field, quoted)
+
+_indexes = {}
+
+class _Inotify(object):
+    """ Just enough of inotify(7) through ctypes to watch one directory. """
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_DELETE = 0x200
+    _event = struct.Struct('iIII')
+
+    def __init__(self, path, mask):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise NotImplementedError('inotify is not available')
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        mode = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, mode | os.O_NONBLOCK)
+        if libc.inotify_add_watch(self.fd, path, mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def read_names(self):
+        """ Names of the entries with pending events, without blocking. """
+        names = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError, err:
+                if err.errno == errno.EAGAIN:
+                    return names
+                raise
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = self._event.unpack_from(buf, pos)
+                pos += self._event.size
+                names.add(buf[pos:pos + length].rstrip('\0'))
+                pos += length
+
+
+class _Watcher(object):
+    """ Dispatches inotify events on a backend's directory from the IOLoop """
+    def __init__(self, backend, io_loop):
+        self.backend = backend
+        self.io_loop = io_loop
+        self.watches = []
+        self.inotify = _Inotify(backend.path,
+                                _Inotify.IN_MODIFY | _Inotify.IN_CLOSE_WRITE |
+                                _Inotify.IN_MOVED_FROM | _Inotify.IN_MOVED_TO |
+                                _Inotify.IN_DELETE)
+        backend.watched = True
+        io_loop.add_handler(self.inotify.fd, self._handle, io_loop.READ)
+
+    def _handle(self, fd, events):
+        keys = self.backend.changed(self.inotify.read_names())
+        for key in keys:
+            _cache.invalidate((self.backend.path, key))
+        for watch in list(self.watches):
+            for key in keys:
+                if key.startswith(watch.prefix):
+                    item = key[watch.strip:]
+                    if item.startswith(_INDEX):
+                        continue
+                    try:
+                        watch.callback(item)
+                    except Exception:
+                        logging.exception("Error in keeper watch callback")
+
+
+class _Watch(object):
+    def __init__(self, watcher, prefix, strip, callback):
+        self.watcher = watcher
+        self.prefix = prefix
+        self.strip = strip
+        self.callback = callback
+
+    def stop(self):
+        if self in self.watcher.watches:
+            self.watcher.watches.remove(self)
+
+
+_watchers = {}
+
+
+def _get_watcher(io_loop):
+    backend = _get_backend()
+    if (backend, io_loop) not in _watchers:
+        _watchers[(backend, io_loop)] = _Watcher(backend, io_loop)
+    return _watchers[(backend, io_loop)]
+
+
+_BACKENDS = {'file': FileBackend,
+             'log': LogBackend}
+_backends = {}
+
+
+def _get_backend():
+    """ Backends are shared per (type, path) so every keeper in a process
+    sees the same index. """
+    name = FLAGS.datastore_backend
+    path = FLAGS.datastore_path
+    if (name, path) not in _backends:
+        _backends[(name, path)] = _BACKENDS[name](path)
+    return _backends[(name, path)]
+
+
+class keeper(object):
+    def __init__(self, prefix="nova-"):
+        self.prefix = prefix
+        self._local = threading.local()
+
+    @property
+    def _pending(self):
+        """ Writes buffered by the calling thread's open transaction """
+        return getattr(self._local, 'pending', None)
+
+    @_pending.setter
+    def _pending(self, value):
+        self._local.pending = value
+
     def _slugify(self, key):
         return key
 
+    def _key(self, item):
+        key = "%s%s" % (self.prefix, self._slugify(item))
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return key
+
     def __delitem__(self, item):
-        item = self._slugify(item)
-        path = "%s/%s%s" % (FLAGS.datastore_path, self.prefix, item)
-        if os.path.isfile(path):
-            os.remove(path)
+        if self._pending is not None:
+            self._pending[item] = _DELETED
+            return
+        self._commit({item: _DELETED})
 
     def __getitem__(self, item):
-        # TODO - Memoize this
-        item = self._slugify(item)
-        path = "%s/%s%s" % (FLAGS.datastore_path, self.prefix, item)
-        if os.path.isfile(path):
-            return anyjson.deserialize(open(path, 'r').read())
-        return None
+        """ The stored value, or None.
 
+        Values are shared with the cache and read-only: dicts and lists
+        raise TypeError on change.  copy.deepcopy() a value to modify it.
+        """
+        if self._pending is not None and item in self._pending:
+            value = self._pending[item]
+            if value is _DELETED:
+                return None
+            return value
+        return self._load(_get_backend(), self._key(item))
+
+    def _load(self, backend, key):
+        cache_key = (backend.path, key)
+        stamp = backend.stamp(key)
+        if stamp is None:
+            _cache.invalidate(cache_key)
+            return None
+        value = _cache.get(cache_key, stamp)
+        if value is not _MISSING:
+            return value
+        data = backend.read(key)
+        if data is None:
+            return None
+        value = _freeze(_decode(data))
+        _cache.put(cache_key, stamp, value)
+        return value
 
     def __setitem__(self, item, value):
-        item = self._slugify(item)
-        path = "%s/%s%s" % (FLAGS.datastore_path, self.prefix, item)
-        f = open(path, "w")
-        f.write(anyjson.serialize(value))
+        if self._pending is not None:
+            self._pending[item] = _freeze(value)
+            return value
+        self._commit({item: value})
         # TODO: Pop and return the old value?
         return value
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Buffer writes and deletes, then commit them in one pass.
+
+        Reads inside the block see the buffered values.  Keys whose value
+        did not change are not rewritten and every changed key is replaced
+        atomically: the file backend writes to a temp file, fsyncs and
+        renames, then syncs the directory once; the log backend appends
+        the whole batch with a single write and fsync.  Nested
+        transactions join the outer one; an exception discards everything
+        buffered.
+        """
+        if self._pending is not None:
+            yield self
+            return
+        self._pending = {}
+        try:
+            yield self
+            pending = self._pending
+        finally:
+            self._pending = None
+        self._commit(pending)
+
+    def keys(self, prefix=''):
+        """ Sorted names of the items that start with prefix. """
+        skip = len(self.prefix)
+        items = set(key[skip:] for key in _get_backend().keys(self._key(prefix)))
+        for item, value in (self._pending or {}).iteritems():
+            if not item.startswith(prefix):
+                continue
+            if value is _DELETED:
+                items.discard(item)
+            else:
+                items.add(item)
+        return sorted(item for item in items if not item.startswith(_INDEX))
+
+    def scan(self, prefix=''):
+        """ Yield (item, value) for every item that starts with prefix. """
+        for item in self.keys(prefix):
+            value = self[item]
+            if value is not None:
+                yield item, value
+
+    def watch(self, prefix, callback, io_loop=None):
+        """ Call callback(item) from the IOLoop whenever an item starting
+        with prefix is written or deleted, by this or any other process.
+
+        Cached values are dropped as soon as the change is seen.  Returns
+        an object whose stop() removes the watch.  Raises
+        NotImplementedError or OSError where inotify isn't available.
+        """
+        if io_loop is None:
+            io_loop = ioloop.IOLoop.instance()
+        watcher = _get_watcher(io_loop)
+        watch = _Watch(watcher, self._key(prefix), len(self.prefix), callback)
+        watcher.watches.append(watch)
+        return watch
+
+    def add_index(self, field):
+        """ Index items by the value of a top level field of their dict.
+
+        Every keeper with this prefix keeps the index up to date as part
+        of each commit; list values are indexed under each element.  The
+        index is built on first use by find().
+        """
+        _indexes.setdefault(self.prefix, set()).add(field)
+
+    def find(self, field, value):
+        """ (item, value) pairs whose field equals or contains value.
+
+        Uses the index if field was declared with add_index, otherwise
+        scans every item.  Writes still buffered in a transaction are not
+        reflected in the index.
+        """
+        value = unicode(value)
+        if field not in _indexes.get(self.prefix, ()):
+            return [(item, stored) for item, stored in self.scan()
+                    if value in _field_values(stored, field)]
+        if self[_INDEX + field] is not True:
+            self._build_index(field)
+        found = []
+        for item in self[_index_item(field, value)] or []:
+            stored = self[item]
+            # a long value's item is shared with any whose hash collides
+            if stored is not None and value in _field_values(stored, field):
+                found.append((item, stored))
+        return found
+
+    def _build_index(self, field):
+        backend = _get_backend()
+        with backend.locked():
+            if self[_INDEX + field] is True:
+                # another process built it while we waited
+                return
+            index = {}
+            for item, value in self.scan():
+                for v in _field_values(value, field):
+                    index.setdefault(_index_item(field, v), []).append(item)
+            raw = {}
+            # anything left over from an older index format
+            for key in backend.keys(self._key(_INDEX + field)):
+                raw[key] = _DELETED
+            for item, items in index.iteritems():
+                raw[self._key(item)] = _encode(items)
+            raw[self._key(_INDEX + field)] = _encode(True)
+            for key in raw:
+                _cache.invalidate((backend.path, key))
+            backend.commit(raw)
+
+    def _commit(self, writes):
+        backend = _get_backend()
+        if not _indexes.get(self.prefix):
+            return self._write(backend, writes)
+        # each touched index item is read, updated and written back, so
+        # writers in other processes must not interleave
+        with backend.locked():
+            return self._write(backend, writes)
+
+    def _write(self, backend, writes):
+        raw = {}
+        changes = []
+        for item, value in writes.iteritems():
+            key = self._key(item)
+            old = self._load(backend, key)
+            if value is _DELETED:
+                if old is None and backend.stamp(key) is None:
+                    continue
+                raw[key] = _DELETED
+                changes.append((item, old, None))
+            elif old != value:
+                raw[key] = _encode(value)
+                changes.append((item, old, value))
+            _cache.invalidate((backend.path, key))
+        for field in _indexes.get(self.prefix, ()):
+            self._update_index(backend, field, changes, raw)
+        if raw:
+            backend.commit(raw)
+
+    def _update_index(self, backend, field, changes, raw):
+        if self._load(backend, self._key(_INDEX + field)) is not True:
+            # not built yet, find() will build it from scratch
+            return
+        touched = {}
+        def items_for(value):
+            key = self._key(_index_item(field, value))
+            if key not in touched:
+                stored = self._load(backend, key)
+                touched[key] = (stored, list(stored or []))
+            return touched[key][1]
+        for item, old, new in changes:
+            if item.startswith(_INDEX):
+                continue
+            before = _field_values(old, field)
+            after = _field_values(new, field)
+            for v in before - after:
+                items = items_for(v)
+                if item in items:
+                    items.remove(item)
+            for v in after - before:
+                items = items_for(v)
+                if item not in items:
+                    items.append(item)
+        for key, (stored, items) in touched.iteritems():
+            if items == list(stored or []):
+                continue
+            raw[key] = items and _encode(items) or _DELETED
+            _cache.invalidate((backend.path, key))
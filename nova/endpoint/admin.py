@@ -1,6 +1,11 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
 import base64
 
+from nova import rpc
+from nova.endpoint import flags
+
+FLAGS = flags.FLAGS
+
 def user_dict(user, base64_file=None):
     if user:
         return {
@@ -46,6 +51,8 @@ class AdminController(object):
     @admin_only
     def deregister_user(self, context, name, **kwargs):
         self.user_manager.delete_user(name)
+        rpc.cast(FLAGS.cloud_topic, {"method": "user_deleted",
+                                     "args": {"user_id": name}})
 
         return True
 
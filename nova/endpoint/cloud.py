@@ -388,13 +388,21 @@ class CloudController(object):
         # TODO: verify user has access to image
         launchstate = self._create_reservation(context.user, kwargs)
         pending = {}
-        for num in range(int(launchstate['max_count'])):
-            launchstate['mac_address'] = utils.generate_mac()
-            (address, launchstate['network_name']) = self.network.allocate_address(str(launchstate['owner_id']), mac=str(launchstate['mac_address']))
-            launchstate['private_dns_name'] = str(address)
-            launchstate = self._really_run_instance(context.user, kwargs, num)
-            pending[kwargs['instance_id']] = dict(launchstate)
-            pending[kwargs['instance_id']]['state'] = node.Instance.NOSTATE
+        messages = []
+        try:
+            for num in range(int(launchstate['max_count'])):
+                launchstate['mac_address'] = utils.generate_mac()
+                (address, launchstate['network_name']) = self.network.allocate_address(str(launchstate['owner_id']), mac=str(launchstate['mac_address']))
+                launchstate['private_dns_name'] = str(address)
+                messages.append(self._run_instance_message(context.user, kwargs, num))
+                pending[kwargs['instance_id']] = dict(launchstate)
+                pending[kwargs['instance_id']]['state'] = node.Instance.NOSTATE
+        except:
+            # nothing has been launched yet, so give the addresses back
+            for instance in pending.values():
+                self.network.deallocate_address(instance['private_dns_name'])
+            raise
+        rpc.call_many(messages)
         # TODO(vish): pending instances will be lost on crash
         if(not self.instances.has_key('pending')):
             self.instances['pending'] = {}
@@ -414,20 +422,23 @@ class CloudController(object):
         return launchstate
 
     def _really_run_instance(self, user, launchstate, idx):
+        rpc.call(*self._run_instance_message(user, launchstate, idx))
+        return launchstate
+
+    def _run_instance_message(self, user, launchstate, idx):
         launchstate['instance_id'] = generate_uid('i')
         launchstate['ami_launch_index'] = idx 
         network = self.network.get_users_network(str(user.id))
-        launchstate['network_str'] = network.to_dict()
+        # to_dict shares the network's hosts, which later allocations change
+        launchstate['network_str'] = copy.deepcopy(network.to_dict())
         launchstate['bridge_name'] = network.bridge_name
         logging.debug("Casting to node for %s's instance with IP of %s in the %s network" %
                       (user.name,
                        launchstate['private_dns_name'],
                        launchstate['network_name']))
-        rpc.call(FLAGS.compute_topic, 
-                              {"method": "run_instance", 
-                               "args" : launchstate 
-                                        })
-        return launchstate
+        # launchstate is reused for the next instance, so send a copy
+        return (FLAGS.compute_topic, {"method": "run_instance",
+                                      "args": dict(launchstate)})
 
     def run_vpn_instance(self, user, **kwargs):
         kwargs['image_id'] = FLAGS.vpn_image_id
@@ -447,30 +458,34 @@ class CloudController(object):
     
     def terminate_instances(self, context, instance_id, **kwargs):
         # TODO: return error if not authorized
+        messages = []
         for i in instance_id:
             node, instance = self._get_instance(i)
             if node == 'pending':
                 raise exception.ApiError('Cannot terminate pending instance')
             if context.user.is_authorized(instance.get('owner_id', None)):
-                rpc.cast('%s.%s' % (FLAGS.compute_topic, node),
-                             {"method": "terminate_instance",
-                              "args" : {"instance_id": i}})
+                messages.append(('%s.%s' % (FLAGS.compute_topic, node),
+                                 {"method": "terminate_instance",
+                                  "args" : {"instance_id": i}}))
             try:
                 self.network.disassociate_address(instance.get('public_dns_name', 'bork'))
             except:
                 pass
+        rpc.cast_many(messages)
         return defer.succeed(True)
 
     def reboot_instances(self, context, instance_id, **kwargs):
         # TODO: return error if not authorized
+        messages = []
         for i in instance_id:
             node, instance = self._get_instance(i)
             if node == 'pending':
                 raise exception.ApiError('Cannot reboot pending instance')
             if context.user.is_authorized(instance.get('owner_id', None)):
-                rpc.cast('%s.%s' % (FLAGS.node_topic, node),
-                             {"method": "reboot_instance",
-                              "args" : {"instance_id": i}})
+                messages.append(('%s.%s' % (FLAGS.node_topic, node),
+                                 {"method": "reboot_instance",
+                                  "args" : {"instance_id": i}}))
+        rpc.cast_many(messages)
         return defer.succeed(True)
 
     def delete_volume(self, context, volume_id, **kwargs):
@@ -542,6 +557,11 @@ class CloudController(object):
 
         return defer.succeed(result)
 
+    def user_deleted(self, user_id):
+        """ gives a deleted user's vlan and network back to the pool """
+        self.network.release_user(user_id)
+        return defer.succeed(True)
+
     def update_state(self, topic, value):
         """ accepts status reports from the queue and consolidates them """
         # TODO(jmc): if an instance has disappeared from the node, call instance_death
@@ -13,6 +13,7 @@ from twisted.internet import defer
 import rpc
 from nova.endpoint import cloud
 import flags
+from nova.compute import network
 from nova.compute import node
 import test
 from nova.auth import users
@@ -21,6 +22,46 @@ from nova.endpoint import api
 FLAGS = flags.FLAGS
 
 
+class FakeUser(object):
+    id = 'fake'
+    name = 'fake'
+
+    def is_authorized(self, owner_id):
+        return owner_id == self.id
+
+    def is_admin(self):
+        return False
+
+
+class FakeNetworkController(object):
+    """ Hands out addresses from one network until limit runs out """
+    def __init__(self, limit):
+        self.limit = limit
+        self.hosts = {}
+        self.bridge_name = 'br100'
+        self.released = []
+
+    def get_users_network(self, user_id):
+        return self
+
+    def to_dict(self):
+        return {'vlan': 100, 'network': '10.0.0.0/24', 'hosts': self.hosts}
+
+    def allocate_address(self, user_id, mac=None):
+        if len(self.hosts) >= self.limit:
+            raise network.NoMoreAddresses()
+        address = '10.0.0.%s' % (len(self.hosts) + 2)
+        self.hosts[address] = user_id
+        return (address, 'fake')
+
+    def deallocate_address(self, address):
+        self.released.append(address)
+        del self.hosts[address]
+
+    def get_public_ip_for_instance(self, instance_id):
+        return None
+
+
 class CloudTestCase(test.BaseTestCase):
     def setUp(self):
         super(CloudTestCase, self).setUp()
@@ -139,3 +180,28 @@ class CloudTestCase(test.BaseTestCase):
         for i in xrange(4):
             data = self.cloud.get_metadata(instance(i)['private_dns_name'])
             self.assert_(data['meta-data']['ami-id'] == 'ami-%s' % i)
+
+    def _run_fake_instances(self, limit, count):
+        sent = []
+        self.stubs.Set(cloud.rpc, 'call_many', sent.extend)
+        self.cloud.network = FakeNetworkController(limit)
+        context = api.APIRequestContext(handler=None, user=FakeUser())
+        self.cloud.run_instances(context, image_id='ami-fake',
+                                 max_count=count)
+        return sent
+
+    def test_run_instances_sends_each_network(self):
+        sent = self._run_fake_instances(limit=3, count=3)
+        hosts = [msg['args']['network_str']['hosts'] for topic, msg in sent]
+        self.assertEqual([sorted(h) for h in hosts],
+                         [['10.0.0.2'],
+                          ['10.0.0.2', '10.0.0.3'],
+                          ['10.0.0.2', '10.0.0.3', '10.0.0.4']])
+
+    def test_run_instances_releases_addresses_on_failure(self):
+        self.assertRaises(network.NoMoreAddresses,
+                          self._run_fake_instances, limit=2, count=3)
+        self.assertEqual(sorted(self.cloud.network.released),
+                         ['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(self.cloud.network.hosts, {})
+        self.assertFalse(self.cloud.instances.get('pending'))
@@ -1,11 +1,13 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
 import logging
+import time
 import unittest
 
 from nova.flags import FLAGS
 from nova.compute import network
 from nova.auth import users
 from IPy import IP
+from tornado import ioloop
 
 
 
@@ -38,6 +40,173 @@ class NetworkTestCase(unittest.TestCase):
         self.assertEqual(net_json, str(net2))
         self.assertTrue(IP(address) in net2.network)
     
+    def test_allocator_reuses_released_addresses(self):
+        net = network.Network(vlan=100, network="192.168.100.0/29", conn=None)
+        addresses = [net.allocate_ip("user0", "01:24:55:36:f2:a0")
+                     for i in range(3)]
+        self.assertEqual(['192.168.100.3', '192.168.100.4', '192.168.100.5'],
+                         addresses)
+        self.assertRaises(network.NoMoreAddresses, net.allocate_ip,
+                          "user0", "01:24:55:36:f2:a0")
+        net.deallocate_ip('192.168.100.4')
+        self.assertFalse(net.is_allocated('192.168.100.4'))
+        self.assertEqual('192.168.100.4',
+                         net.allocate_ip("user1", "01:24:55:36:f2:a0"))
+        self.assertTrue(net.is_allocated('192.168.100.4'))
+        reloaded = network.Network.from_json(str(net))
+        self.assertRaises(network.NoMoreAddresses, reloaded.allocate_ip,
+                          "user0", "01:24:55:36:f2:a0")
+
+    def test_deallocate_releases_vpn_address(self):
+        net = network.PrivateNetwork("127.0.0.1", 8000, vlan=100,
+                                     network="192.168.100.0/29", conn=None)
+        address = net.get_vpn_ip("user0", "01:24:55:36:f2:a0")
+        self.assertTrue(net.is_allocated(address))
+        net.deallocate_ip(address)
+        self.assertFalse(net.is_allocated(address))
+
+    def test_allocator_reuses_oldest_release_first(self):
+        net = network.Network(vlan=100, network="192.168.100.0/28", conn=None)
+        addresses = [net.allocate_ip("user0", "01:24:55:36:f2:a0")
+                     for i in range(3)]
+        net.deallocate_ip(addresses[0])
+        net.deallocate_ip(addresses[1])
+        # never-used addresses come first, then the oldest release
+        rest = [net.allocate_ip("user0", "01:24:55:36:f2:a0")
+                for i in range(10)]
+        self.assertEqual(addresses[:2], rest[-2:])
+
+    def test_iptables_batches_changes(self):
+        commands = []
+        def execute(cmd, input=None):
+            commands.append((cmd, input))
+            return ('', '')
+        original = network.execute
+        network.execute = execute
+        fake_network = FLAGS.fake_network
+        FLAGS.fake_network = False
+        try:
+            rules = network.IptablesManager('nova')
+            rules.add_rule("PREROUTING -t nat -d 1.2.3.4 -j DNAT --to 10.0.0.3")
+            rules.add_rule("FORWARD -d 10.0.0.3 -p icmp -j ACCEPT")
+            rules.apply()
+            restores = [input for (cmd, input) in commands
+                        if cmd.endswith("iptables-restore --noflush")]
+            self.assertEqual(1, len(restores))
+            self.assertTrue("-I PREROUTING -j nova-prerouting" in restores[0])
+            self.assertTrue("-A nova-forward -d 10.0.0.3 -p icmp -j ACCEPT"
+                            in restores[0])
+            del commands[:]
+            rules.add_rule("FORWARD -d 10.0.0.3 -p icmp -j ACCEPT")
+            rules.apply()
+            self.assertEqual([], commands)
+            rules.remove_rule("FORWARD -d 10.0.0.3 -p icmp -j ACCEPT")
+            rules.apply()
+            self.assertEqual(1, len(commands))
+            self.assertFalse("nova-prerouting" in commands[0][1])
+        finally:
+            network.execute = original
+            FLAGS.fake_network = fake_network
+
+    def test_iptables_takes_over_running_rules(self):
+        saved = {'filter': "*filter\n"
+                           ":nova-compute-forward - [0:0]\n"
+                           ":nova-compute-input - [0:0]\n"
+                           "-A FORWARD -j nova-compute-forward\n"
+                           "-A FORWARD -d 10.0.0.3/32 -p icmp -j ACCEPT\n"
+                           "-A FORWARD -d 10.0.0.4/32 -p icmp -j ACCEPT\n"
+                           "-A FORWARD -d 10.0.0.3/32 -p tcp -m tcp "
+                           "--dport 80 -j ACCEPT\n"
+                           "-A nova-compute-input -s 10.0.0.9/32 -j DROP\n"
+                           "COMMIT\n"}
+        commands = []
+        def execute(cmd, input=None):
+            commands.append((cmd, input))
+            if "iptables-save" in cmd:
+                return (saved[cmd.split()[-1]], '')
+            return ('', '')
+        original = network.execute
+        network.execute = execute
+        fake_network = FLAGS.fake_network
+        FLAGS.fake_network = False
+        try:
+            rules = network.IptablesManager('nova-compute')
+            other = network.IptablesManager('nova-api')
+            self.assertEqual('nova-compute-forward', rules._chain('FORWARD'))
+            self.assertEqual('nova-api-forward', other._chain('FORWARD'))
+            rules.add_rule("FORWARD -d 10.0.0.3 -p icmp -j ACCEPT")
+            rules.apply()
+            restores = [input for (cmd, input) in commands
+                        if cmd.endswith("iptables-restore --noflush")]
+            self.assertEqual(1, len(restores))
+            # already hooked from the last run
+            self.assertFalse("-I FORWARD" in restores[0])
+            # the leftover chain is emptied
+            self.assertTrue(":nova-compute-input - [0:0]" in restores[0])
+            self.assertTrue("-I INPUT -j nova-compute-input" in restores[0])
+            deletes = [cmd for (cmd, input) in commands if "--delete" in cmd]
+            self.assertEqual(["sudo iptables -t filter --delete FORWARD "
+                              "-d 10.0.0.3 -p icmp -j ACCEPT"], deletes)
+            # each legacy rule is only deleted once
+            del commands[:]
+            rules.remove_rule("FORWARD -d 10.0.0.3 -p icmp -j ACCEPT")
+            rules.apply()
+            rules.add_rule("FORWARD -d 10.0.0.3 -p icmp -j ACCEPT")
+            rules.apply()
+            self.assertEqual([], [cmd for (cmd, input) in commands
+                                  if "--delete" in cmd])
+        finally:
+            network.execute = original
+            FLAGS.fake_network = fake_network
+
+    def test_iptables_fake_network(self):
+        commands = []
+        original = network.execute
+        network.execute = lambda cmd, input=None: commands.append(cmd)
+        fake_network = FLAGS.fake_network
+        FLAGS.fake_network = True
+        try:
+            rules = network.IptablesManager()
+            rules.add_rule("FORWARD -d 10.0.0.3 -p icmp -j ACCEPT")
+            rules.apply()
+            self.assertEqual([], commands)
+        finally:
+            network.execute = original
+            FLAGS.fake_network = fake_network
+
+    def test_dhcp_updates_are_batched(self):
+        net = network.DHCPNetwork(vlan=100, network="192.168.100.0/24", conn=None)
+        reloads = []
+        net.start_dnsmasq = lambda: reloads.append(len(net.hosts))
+        batched = []
+        def update():
+            for i in range(3, 8):
+                address = "192.168.100.%d" % i
+                net.hosts[address] = {"address": address, "user_id": "user0",
+                                      "mac": "01:24:55:36:f2:a0"}
+                net.update_dhcp()
+            batched.extend(reloads)
+        io_inst = ioloop.IOLoop.instance()
+        io_inst.add_callback(update)
+        io_inst.add_timeout(
+                time.time() + FLAGS.dhcp_update_delay / 1000.0 + 0.1,
+                io_inst.stop)
+        io_inst.start()
+        self.assertEqual([], batched)
+        self.assertEqual([5], reloads)
+        # the timeout has fired, so there's nothing left to cancel
+        net._cancel_dhcp()
+
+    def test_dhcp_updates_without_loop(self):
+        net = network.DHCPNetwork(vlan=100, network="192.168.100.0/24", conn=None)
+        reloads = []
+        net.start_dnsmasq = lambda: reloads.append(len(net.hosts))
+        net.hosts["192.168.100.3"] = {"address": "192.168.100.3",
+                                      "user_id": "user0",
+                                      "mac": "01:24:55:36:f2:a0"}
+        net.update_dhcp()
+        self.assertEqual([1], reloads)
+
     def test_allocate_deallocate_address(self):
         (address, net_name) = self.network.allocate_address("user0", "01:24:55:36:f2:a0")
         logging.debug("Was allocated %s" % (address))
@@ -45,6 +214,21 @@ class NetworkTestCase(unittest.TestCase):
         rv = self.network.deallocate_address(address)
         self.assertEqual(False, address in self._get_user_addresses("user0"))
 
+    def test_deallocate_without_user_lookups(self):
+        (address, net_name) = self.network.allocate_address("user0", "01:24:55:36:f2:a0")
+        def get_user(user_id):
+            raise AssertionError("looked up %s" % user_id)
+        self.network.manager.get_user = get_user
+        try:
+            self.network.deallocate_address(address)
+            self.assertRaises(network.AddressNotAllocated,
+                              self.network.deallocate_address, address)
+            self.assertRaises(network.AddressNotAllocated,
+                              self.network.deallocate_address, "10.0.0.3")
+        finally:
+            del self.network.manager.get_user
+        self.assertEqual(False, address in self._get_user_addresses("user0"))
+
     def test_range_allocation(self):
         (address, net_name) = self.network.allocate_address("user0", "01:24:55:36:f2:a0")
         (secondaddress, net_name) = self.network.allocate_address("user1", "01:24:55:36:f2:a0")
@@ -72,17 +256,78 @@ class NetworkTestCase(unittest.TestCase):
             rv = self.network.deallocate_address(address3)
         rv = self.network.deallocate_address(secondaddress)
 
+    def test_save_and_reconcile_users(self):
+        name = 'reconcile-user'
+        self.manager.create_user(name, name, name)
+        (address, net_name) = self.network.allocate_address(name, "01:24:55:36:f2:a0")
+        self.assertTrue(address in network.KEEPER['%s-default' % name]['hosts'])
+        self.assertFalse(self.network.private_nets[name].dirty)
+        self.manager.delete_user(name)
+        self.network.reconcile_users()
+        self.assertFalse(name in self.network.private_nets)
+        self.assertFalse(name in [net['user_id'] for net in
+                                  network.KEEPER['private']['networks']])
+
+    def test_express_networks(self):
+        self.network.allocate_address("user0", "01:24:55:36:f2:a0")
+        controller = network.NetworkController(netsize=16)
+        self.assertEqual({}, controller.private_nets)
+        expressed = []
+        express = network.PrivateNetwork.express
+        def record(net, *args, **kwargs):
+            expressed.append(net.vlan)
+        network.PrivateNetwork.express = record
+        try:
+            io_inst = ioloop.IOLoop.instance()
+            d = controller.express_networks()
+            d.addCallback(lambda _: io_inst.stop())
+            io_inst.add_timeout(time.time() + 5, io_inst.stop)
+            io_inst.start()
+        finally:
+            network.PrivateNetwork.express = express
+        self.assertTrue(d.called)
+        self.assertTrue(controller.private_nets["user0"].vlan in expressed)
+
+    def test_vlan_pool(self):
+        pool = network.VlanPool(start=10, end=14, vlans={'user0': 12})
+        self.assertEqual(11, pool.next('user1'))
+        self.assertEqual(13, pool.next('user2'))
+        self.assertEqual(13, pool.next('user2'))
+        self.assertRaises(network.AddressNotAllocated, pool.next, 'user3')
+        pool.release('user0')
+        self.assertEqual(12, pool.next('user3'))
+        reloaded = network.VlanPool.from_json(str(pool))
+        self.assertRaises(network.AddressNotAllocated, reloaded.next, 'user4')
+
     def test_too_many_users(self):
         for i in range(0, 30):
             name = 'toomany-user%s' % i
             self.manager.create_user(name, name, name)
             (address, net_name) = self.network.allocate_address(name, "01:24:55:36:f2:a0")
             self.manager.delete_user(name)
+            self.network.release_user(name)
         
         
     def test_associate_deassociate_address(self):
-        #raise NotImplementedError
-        pass
+        (public_ip, net_name) = self.network.allocate_address(
+                "user0", "01:24:55:36:f2:a0", type=network.PublicNetwork)
+        self.network.associate_address(public_ip, "10.128.0.3", "i-1")
+        self.assertEqual(public_ip,
+                         self.network.get_public_ip_for_instance("i-1"))
+        (other_ip, net_name) = self.network.allocate_address(
+                "user0", "01:24:55:36:f2:a0", type=network.PublicNetwork)
+        self.assertRaises(network.AddressAlreadyAssociated,
+                          self.network.associate_address,
+                          other_ip, "10.128.0.3", "i-2")
+        reloaded = network.PublicNetwork.from_json(
+                str(self.network.public_net))
+        self.assertEqual(public_ip, reloaded.public_ip_for_instance("i-1"))
+        self.network.disassociate_address(public_ip)
+        self.assertEqual(None, self.network.get_public_ip_for_instance("i-1"))
+        self.network.associate_address(other_ip, "10.128.0.3", "i-2")
+        self.network.deallocate_address(other_ip)
+        self.assertEqual(None, self.network.get_public_ip_for_instance("i-2"))
+        self.network.deallocate_address(public_ip)
 
     def _get_user_addresses(self, user_id):
         rv = self.network.describe_addresses()
@@ -1,9 +1,21 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
 """ Based a bit on the carrot.backeds.queue backend... but a lot better """
+import collections
 import logging
-import Queue as queue
 
 from carrot.backends import base
+from tornado import ioloop
+
+import flags
+
+FLAGS = flags.FLAGS
+# imported both as nova.fakerabbit and, from inside nova/, as plain fakerabbit
+if not FLAGS.has_key('fake_rabbit_delivery'):
+    flags.DEFINE_string('fake_rabbit_delivery', 'poll',
+                        'how fake_rabbit hands messages to consumers: poll '
+                        '(consumers fetch them), direct (straight to the '
+                        'consumer callback as they are published) or deferred '
+                        '(to the callback on the next IOLoop iteration)')
 
 
 class Message(base.BaseMessage):
@@ -14,12 +26,15 @@ class Exchange(object):
     def __init__(self, name, exchange_type):
         self.name = name
         self.exchange_type = exchange_type
-        self._queue = queue.Queue()
         self._routes = {}
+        self.messages = 0
+        self.bytes = 0
 
     def publish(self, message, routing_key=None):
         logging.debug('(%s) publish (key: %s) %s',
                       self.name, routing_key, message)
+        self.messages += 1
+        self.bytes += len(message[0])
         if routing_key in self._routes:
             for f in self._routes[routing_key]:
                 logging.debug('Publishing to route %s', f)
@@ -33,19 +48,55 @@ class Exchange(object):
 class Queue(object):
     def __init__(self, name):
         self.name = name
-        self._queue = queue.Queue()
+        self._queue = collections.deque()
+        self._deferred = collections.deque()
+        self._consumers = []
 
     def __repr__(self):
         return '<Queue: %s>' % self.name
     
     def push(self, message, routing_key=None):
-        self._queue.put(message)
+        if self._consumers and FLAGS.fake_rabbit_delivery != 'poll':
+            self._deliver(message)
+        else:
+            self._queue.append(message)
 
     def size(self):
-        return self._queue.qsize()
+        return len(self._queue)
 
     def pop(self):
-        return self._queue.get()
+        return self._queue.popleft()
+
+    def consume(self, consumer_tag, callback):
+        self._consumers.append((consumer_tag, callback))
+        while self._queue:
+            self._deliver(self._queue.popleft())
+
+    def cancel(self, consumer_tag):
+        self._consumers = [(tag, callback) for tag, callback in self._consumers
+                           if tag != consumer_tag]
+
+    def _deliver(self, message):
+        if FLAGS.fake_rabbit_delivery == 'deferred':
+            # one flush per iteration keeps the messages in order
+            if not self._deferred:
+                ioloop.IOLoop.instance().add_callback(self._flush)
+            self._deferred.append(message)
+            return
+        # round robin between consumers, as rabbit does
+        consumer = self._consumers.pop(0)
+        self._consumers.append(consumer)
+        consumer[1](message)
+
+    def _flush(self):
+        messages, self._deferred = self._deferred, collections.deque()
+        while messages:
+            if not self._consumers:
+                self._queue.extend(messages)
+                return
+            consumer = self._consumers.pop(0)
+            self._consumers.append(consumer)
+            consumer[1](messages.popleft())
 
 
 class Backend(object):
@@ -53,12 +104,23 @@ class Backend(object):
     class __impl(base.BaseBackend):
         def __init__(self, *args, **kwargs):
             #super(__impl, self).__init__(*args, **kwargs)
-            self._exchanges = {}
-            self._queues = {}
+            self._reset_all()
         
         def _reset_all(self):
             self._exchanges = {}
             self._queues = {}
+            self._consumers = {}
+
+        @property
+        def pushes(self):
+            """ Whether consumers get messages without polling for them """
+            return FLAGS.fake_rabbit_delivery != 'poll'
+
+        def stats(self):
+            """ Messages and bytes published to each exchange """
+            return dict((name, {'messages': exchange.messages,
+                                'bytes': exchange.bytes})
+                        for name, exchange in self._exchanges.iteritems())
 
         def queue_declare(self, queue, **kwargs):
             if queue not in self._queues:
@@ -79,14 +141,26 @@ class Backend(object):
         def get(self, queue, no_ack=False):
             if not self._queues[queue].size():
                 return None
-            (message_data, content_type, content_encoding) = \
-                    self._queues[queue].pop()
-            message = Message(backend=self, body=message_data,
-                              content_type=content_type,
-                              content_encoding=content_encoding)
+            message = self.message_to_python(self._queues[queue].pop())
             logging.debug('Getting from %s: %s', queue, message)
             return message
 
+        def declare_consumer(self, queue, no_ack, callback, consumer_tag,
+                             **kwargs):
+            self._consumers[consumer_tag] = queue
+            self._queues[queue].consume(consumer_tag, callback)
+
+        def cancel(self, consumer_tag):
+            queue = self._consumers.pop(consumer_tag, None)
+            if queue in self._queues:
+                self._queues[queue].cancel(consumer_tag)
+
+        def message_to_python(self, raw_message):
+            (message_data, content_type, content_encoding) = raw_message
+            return Message(backend=self, body=message_data,
+                           content_type=content_type,
+                           content_encoding=content_encoding)
+
         def prepare_message(self, message_data, delivery_mode,
                             content_type, content_encoding, **kwargs):
             """Prepare message for sending."""
@@ -112,5 +186,19 @@ class Backend(object):
         return setattr(self.__instance, attr, value)
 
 
+_reset_hooks = []
+
+
+def on_reset(hook):
+    """ Call hook() after every reset_all, e.g. to forget declared queues """
+    _reset_hooks.append(hook)
+
+
 def reset_all():
     Backend()._reset_all()
+    for hook in _reset_hooks:
+        hook()
+
+
+def stats():
+    return Backend().stats()
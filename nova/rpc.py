@@ -1,28 +1,124 @@
 # vim: tabstop=4 shiftwidth=4 softtabstop=4
+import collections
+import contextlib
+import errno
+import functools
+import os
+import Queue
+import select
+import socket
+import ssl
+import struct
 import sys
+import threading
+import time
 import uuid
 import logging
+import marshal
+import zlib
 
 import contrib # adds contrib to the path
 import anyjson
 
+from amqplib.client_0_8 import exceptions as amqp_exceptions
 from carrot import connection
 from carrot import messaging
+from carrot import serialization
 
 from tornado import ioloop
 from twisted.internet import defer
+from twisted.python import failure
 
 import fakerabbit
 import flags
 
 FLAGS = flags.FLAGS
 
+# rpc is imported both as nova.rpc and, from inside nova/, as plain rpc
+if not FLAGS.has_key('rpc_timeout'):
+    flags.DEFINE_integer('rpc_timeout', 60,
+                         'seconds to wait for an rpc.call reply, 0 to wait forever')
+if not FLAGS.has_key('rpc_publisher_pool_size'):
+    flags.DEFINE_integer('rpc_publisher_pool_size', 64,
+                         'declared publishers kept open per connection')
+if not FLAGS.has_key('rpc_prefetch_count'):
+    flags.DEFINE_integer('rpc_prefetch_count', 16,
+                         'unacked messages the broker may send each service')
+    flags.DEFINE_integer('rpc_max_inflight', 16,
+                         'rpc.blocking proxy calls a service runs at once, 0 for no limit')
+    flags.DEFINE_integer('rpc_worker_threads', 4,
+                         'threads that run proxy methods marked rpc.blocking')
+if not FLAGS.has_key('rpc_serializer'):
+    flags.DEFINE_string('rpc_serializer', 'json',
+                        'codec rpc messages are sent in: json or marshal')
+    flags.DEFINE_integer('rpc_compress_size', 0,
+                         'zlib compress rpc messages bigger than this many bytes, '
+                         '0 to never compress')
+if not FLAGS.has_key('rpc_stats_window'):
+    flags.DEFINE_integer('rpc_stats_window', 1000,
+                         'recent samples kept for each rpc timing histogram')
+
 
 _log = logging.getLogger('amqplib')
 _log.setLevel(logging.WARN)
 
 
+# marshal is much cheaper than json for the state dicts nodes report, but
+# only python speaks it, so peers must all be nova
+serialization.registry.register('marshal', marshal.dumps, marshal.loads,
+                                content_type='application/x-nova-marshal',
+                                content_encoding='binary')
+_ZLIB = '+zlib'
+
+
+def _register_compressed(name):
+    content_type, content_encoding, encoder = \
+            serialization.registry._encoders[name]
+    def decoder(data):
+        return serialization.registry.decode(zlib.decompress(data),
+                                             content_type, content_encoding)
+    serialization.registry.register(name + _ZLIB, None, decoder,
+                                    content_type=content_type + _ZLIB,
+                                    content_encoding='binary')
+
+for name in ('json', 'marshal'):
+    _register_compressed(name)
+
+
 class Connection(connection.BrokerConnection):
+    """ A broker connection, which also picks how its messages are encoded.
+
+    Each connection sends in its own serializer, zlib compressing bodies
+    over compress_size; consumers decode whatever content type a message
+    says it is, and replies are sent back in the codec of the request.
+    """
+    def __init__(self, *args, **kwargs):
+        self.serializer = kwargs.pop('serializer', None) or \
+                FLAGS.rpc_serializer
+        self.compress_size = kwargs.pop('compress_size',
+                                        FLAGS.rpc_compress_size)
+        super(Connection, self).__init__(*args, **kwargs)
+
+    def negotiate(self, content_type):
+        """ The serializer to answer a message of content_type in """
+        if content_type:
+            base = content_type.split(_ZLIB)[0]
+            for name, (ct, ce, encoder) in \
+                    serialization.registry._encoders.items():
+                if ct == base and _ZLIB not in name:
+                    return name
+        return self.serializer
+
+    def encode(self, message_data, serializer=None):
+        """ (content_type, content_encoding, body) for message_data """
+        content_type, content_encoding, body = serialization.encode(
+                message_data, serializer=serializer or self.serializer)
+        if self.compress_size and len(body) > self.compress_size:
+            if isinstance(body, unicode):
+                body = body.encode(content_encoding)
+            return content_type + _ZLIB, 'binary', zlib.compress(body)
+        return content_type, content_encoding, body
+
     @classmethod
     def instance(cls):
         if not hasattr(cls, '_instance'):
@@ -38,17 +134,322 @@ class Connection(connection.BrokerConnection):
             cls._instance = cls(**params)
         return cls._instance
 
+    @property
+    def publishers(self):
+        """ The PublisherPool for this connection """
+        if not hasattr(self, '_publishers'):
+            self._publishers = PublisherPool(self)
+        return self._publishers
+
+
+class Histogram(object):
+    """ Rolling window of the most recent timings for one rpc stage """
+    # upper bounds in ms
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+               30000)
+
+    def __init__(self):
+        self.samples = collections.deque(maxlen=FLAGS.rpc_stats_window)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append((time.time(), seconds))
+        self.count += 1
+
+    def snapshot(self):
+        """ Counts, rate and latencies (in ms) over the current window """
+        if not self.samples:
+            return {'count': self.count}
+        timings = sorted(seconds for when, seconds in self.samples)
+        span = time.time() - self.samples[0][0]
+        pct = lambda p: timings[min(len(timings) - 1,
+                                    int(len(timings) * p / 100.0))] * 1000
+        buckets = {}
+        for seconds in timings:
+            for bound in self.BUCKETS:
+                if seconds * 1000 <= bound:
+                    break
+            else:
+                bound = 'inf'
+            buckets[str(bound)] = buckets.get(str(bound), 0) + 1
+        return {'count': self.count,
+                'window': len(timings),
+                'rate': span and len(timings) / span or None,
+                'p50': pct(50), 'p90': pct(90), 'p99': pct(99),
+                'max': timings[-1] * 1000,
+                'buckets': buckets}
+
+
+# topic -> method -> stage -> Histogram, where stage is one of publish,
+# queue (sender's timestamp to handler start), handler and reply (the
+# caller's round trip)
+_stats = collections.defaultdict(
+        lambda: collections.defaultdict(
+                lambda: collections.defaultdict(Histogram)))
+
+
+def record(stage, topic, method, seconds):
+    _stats[topic][str(method)][stage].add(seconds)
+
+
+def stats():
+    """ Snapshot of every rpc timing histogram in this process """
+    return dict((topic, dict((method, dict((stage, hist.snapshot())
+                                           for stage, hist in stages.items()))
+                             for method, stages in methods.items()))
+                for topic, methods in _stats.items())
+
+
+def dump_stats(path):
+    """ Write stats() to path as json, replacing it atomically """
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        f.write(anyjson.serialize(stats()))
+    os.rename(tmp, path)
+
+
+def _amqp_connection(conn):
+    """ The underlying amqplib connection, if this backend has a socket """
+    amqp = conn.connection
+    if getattr(amqp, 'transport', None) is None:
+        return None
+    return amqp
+
+
+class _WouldBlock(Exception):
+    pass
+
+
+class _FrameSource(object):
+    """ Stands in for the transport as amqplib's frame source.
+
+    It buffers whatever the socket has, so that while nonblocking is set
+    a frame that hasn't fully arrived raises _WouldBlock instead of
+    stalling the IOLoop.  amqplib keeps the frames of a half read method
+    and carries on with them on the next read.  Otherwise it blocks, as
+    synchronous calls like declares expect.
+    """
+    _header = struct.Struct('>BHI')
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.nonblocking = False
+        # plain tcp transports may already have read ahead
+        self.buffer = getattr(transport, '_read_buffer', '')
+        if self.buffer:
+            transport._read_buffer = ''
+
+    def _frame_size(self):
+        if len(self.buffer) < self._header.size:
+            return None
+        size = self._header.unpack_from(self.buffer)[2] + self._header.size + 1
+        if len(self.buffer) < size:
+            return None
+        return size
+
+    def pending(self):
+        return self._frame_size() is not None
+
+    def _recv(self):
+        sslobj = getattr(self.transport, 'sslobj', None)
+        sock = sslobj or self.transport.sock
+        if self.nonblocking:
+            buffered = sslobj is not None and sslobj.pending()
+            if not buffered and not select.select([sock], [], [], 0)[0]:
+                return False
+            sock.settimeout(0.0)
+        try:
+            data = sock.recv(65536)
+        except ssl.SSLError, e:
+            if e.args[0] != ssl.SSL_ERROR_WANT_READ:
+                raise
+            return False
+        except socket.error, e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+            return False
+        finally:
+            sock.settimeout(None)
+        if not data:
+            raise IOError('Socket closed')
+        self.buffer += data
+        return True
+
+    def read_frame(self):
+        while not self.pending():
+            if not self._recv():
+                raise _WouldBlock()
+        size = self._frame_size()
+        frame, self.buffer = self.buffer[:size], self.buffer[size:]
+        if frame[-1] != '\xce':
+            raise Exception('Framing Error, received 0x%02x while expecting 0xce' % ord(frame[-1]))
+        frame_type, channel, payload_size = self._header.unpack_from(frame)
+        return frame_type, channel, frame[self._header.size:-1]
+
+
+class _Reader(object):
+    """ Reads an AMQP connection's socket from the IOLoop.
+
+    There is one per connection and IOLoop: the socket is registered with
+    IOLoop.add_handler and every readable event dispatches the complete
+    AMQP methods that have arrived to the basic_consume callbacks of
+    whichever channels they belong to, without waiting for the rest.
+    """
+    _readers = {}
+
+    @classmethod
+    def get(cls, amqp, io_inst):
+        key = (id(amqp), io_inst)
+        if key not in cls._readers:
+            cls._readers[key] = cls(amqp, io_inst)
+        return cls._readers[key]
+
+    def __init__(self, amqp, io_inst):
+        self.amqp = amqp
+        self.io_inst = io_inst
+        self.fd = amqp.transport.sock.fileno()
+        self.consumers = set()
+        self.closed = False
+        self.source = amqp.method_reader.source
+        if not isinstance(self.source, _FrameSource):
+            self.source = amqp.method_reader.source = \
+                    _FrameSource(amqp.transport)
+        io_inst.add_handler(self.fd, self._handle, io_inst.READ)
+
+    def _handle(self, fd, events):
+        if events & self.io_inst.ERROR:
+            logging.error('AMQP connection closed')
+            self.close()
+            return
+        self.drain_pending()
+
+    def _queued(self):
+        for channel in self.amqp.channels.values():
+            if channel.method_queue:
+                return True
+        return False
+
+    def _read_method(self):
+        """ Queue the next complete method on its channel, if it's here """
+        self.source.nonblocking = True
+        try:
+            method = self.amqp.method_reader.read_method()
+        except _WouldBlock:
+            return False
+        finally:
+            self.source.nonblocking = False
+        channel, method_sig, args, content = method
+        self.amqp.channels[channel].method_queue.append(
+                (method_sig, args, content))
+        return True
+
+    def drain_pending(self):
+        """ Dispatch every method that has arrived, including any read from
+        the socket while someone else (a synchronous declare, say) was
+        waiting on it.  Callbacks run with the socket back in blocking
+        mode, so they may make synchronous calls themselves. """
+        try:
+            while self._queued() or self._read_method():
+                self.amqp.drain_events()
+        except amqp_exceptions.AMQPChannelException, e:
+            # the channel is closed now; its PublisherPool entry is replaced
+            # the next time it's used
+            _log.warn('AMQP channel closed: %s' % (e,))
+        except (amqp_exceptions.AMQPConnectionException, socket.error,
+                IOError), e:
+            logging.error('AMQP connection lost: %s' % (e,))
+            self.close()
+
+    def close(self):
+        if self._readers.pop((id(self.amqp), self.io_inst), None) is None:
+            return
+        self.closed = True
+        self.io_inst.remove_handler(self.fd)
+
+
+class _Attached(object):
+    """ Handle returned by attach_to_tornado; stop() cancels the consumer """
+    def __init__(self, consumer, reader):
+        self.consumer = consumer
+        self.reader = reader
+        self.stopped = False
+        if reader is not None:
+            reader.consumers.add(self)
+
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.consumer.backend.cancel(self.consumer.consumer_tag)
+        if self.reader is None:
+            return
+        self.reader.consumers.discard(self)
+        if not self.reader.consumers:
+            self.reader.close()
+
+
+def _drain_pending(conn):
+    """ Schedule delivery of anything read off the socket by a sync call """
+    amqp = _amqp_connection(conn)
+    if amqp is None:
+        return
+    for (amqp_id, io_inst), reader in _Reader._readers.items():
+        if amqp_id == id(amqp):
+            io_inst.add_callback(reader.drain_pending)
+
+
+@contextlib.contextmanager
+def _corked(conn):
+    """ Hold partial frames back so a batch leaves in as few packets as
+    possible, flushed when the block ends. """
+    amqp = _amqp_connection(conn)
+    cork = getattr(socket, 'TCP_CORK', None)
+    if amqp is None or cork is None:
+        yield
+        return
+    sock = amqp.transport.sock
+    sock.setsockopt(socket.IPPROTO_TCP, cork, 1)
+    try:
+        yield
+    finally:
+        sock.setsockopt(socket.IPPROTO_TCP, cork, 0)
+
 
 class Consumer(messaging.Consumer):
     # TODO(termie): it would be nice to give these some way of automatically
     #               cleaning up after themselves
+    prefetch_count = 0
+
     def attach_to_tornado(self, io_inst=None):
+        """ Deliver messages to this consumer's callbacks from the IOLoop.
+
+        With a real broker this is push based: basic_consume on our channel
+        and the connection's socket is watched for readability.  fakerabbit
+        delivers to the callback itself unless its delivery mode is poll, in
+        which case we fetch every millisecond instead.
+        """
         if io_inst is None:
             io_inst = ioloop.IOLoop.instance()
 
-        injected = ioloop.PeriodicCallback(
-            lambda: self.fetch(enable_callbacks=True), 1, io_loop=io_inst)
-        injected.start()
+        amqp = _amqp_connection(self.connection)
+        if amqp is None and not getattr(self.backend, 'pushes', False):
+            injected = ioloop.PeriodicCallback(
+                lambda: self.fetch(enable_callbacks=True), 1, io_loop=io_inst)
+            injected.start()
+            return injected
+
+        if self.prefetch_count:
+            self.qos(prefetch_count=self.prefetch_count)
+        self.backend.declare_consumer(queue=self.queue,
+                                      no_ack=self.no_ack,
+                                      callback=self._receive_callback,
+                                      consumer_tag=self.consumer_tag)
+        if amqp is None:
+            # fakerabbit hands messages straight to the callback
+            return _Attached(self, None)
+        injected = _Attached(self, _Reader.get(amqp, io_inst))
+        # anything that arrived while declaring is already buffered
+        io_inst.add_callback(injected.reader.drain_pending)
         return injected
 
     attachToTornado = attach_to_tornado
@@ -58,6 +459,78 @@ class Publisher(messaging.Publisher):
     pass
 
 
+class PublisherPool(object):
+    """ Declared publishers kept open and reused across sends.
+
+    Publishers are keyed by (exchange, routing_key), each on its own
+    channel, so a send costs one basic_publish rather than a channel open,
+    exchange declare and close.  A send that fails throws the publisher
+    away and is retried once on a fresh one.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.publishers = collections.OrderedDict()
+
+    def get(self, publisher_cls, exchange, routing_key, **kwargs):
+        key = (exchange, routing_key)
+        publisher = self.publishers.pop(key, None)
+        if publisher is None:
+            publisher = publisher_cls(connection=self.connection, **kwargs)
+        self.publishers[key] = publisher
+        while len(self.publishers) > FLAGS.rpc_publisher_pool_size:
+            self._close(self.publishers.popitem(last=False)[1])
+        return publisher
+
+    def discard(self, exchange, routing_key):
+        publisher = self.publishers.pop((exchange, routing_key), None)
+        if publisher is not None:
+            self._close(publisher)
+
+    def _close(self, publisher):
+        try:
+            publisher.close()
+        except Exception:
+            pass
+
+    def send(self, publisher_cls, exchange, routing_key, messages,
+             serializer=None, **kwargs):
+        """ Publish (routing_key, message_data) pairs on one publisher """
+        # a message that can't be encoded fails the batch before any of it
+        # is sent
+        messages = [(key, self.connection.encode(message_data, serializer))
+                    for key, message_data in messages]
+        sent = 0
+        for attempt in (0, 1):
+            publisher = self.get(publisher_cls, exchange, routing_key,
+                                 **kwargs)
+            try:
+                for key, (content_type, content_encoding, body) in \
+                        messages[sent:]:
+                    publisher.send(body, routing_key=key,
+                                   content_type=content_type,
+                                   content_encoding=content_encoding)
+                    sent += 1
+                return
+            except Exception, e:
+                self.discard(exchange, routing_key)
+                if attempt:
+                    raise
+                _log.warn('Publishing to %s failed, reopening: %s' %
+                          (exchange, e))
+
+    def topic(self, topic, message_data):
+        self.send(TopicPublisher, FLAGS.control_exchange, topic,
+                  [(topic, message_data)], topic=topic)
+
+    def topics(self, messages):
+        """ Send (topic, message_data) pairs, all on the same channel """
+        self.send(TopicPublisher, FLAGS.control_exchange, None, messages)
+
+    def direct(self, msg_id, message_data, serializer=None):
+        self.send(DirectPublisher, msg_id, msg_id, [(msg_id, message_data)],
+                  serializer=serializer, msg_id=msg_id)
+
+
 class TopicConsumer(Consumer):
     exchange_type = "topic" 
     def __init__(self, connection=None, topic="broadcast"):
@@ -67,29 +540,129 @@ class TopicConsumer(Consumer):
         super(TopicConsumer, self).__init__(connection=connection)
 
 
+def blocking(func):
+    """ Mark a proxy method as blocking.
+
+    AdapterConsumer runs blocking methods on a worker thread rather than on
+    the IOLoop, so they don't hold up every other message to the service.
+    """
+    func.blocking = True
+    return func
+
+
+class WorkerPool(object):
+    """ Threads that run blocking proxy methods, firing the Deferred for
+    each result back on the IOLoop. """
+    def __init__(self, size, io_inst=None):
+        self.io_inst = io_inst or ioloop.IOLoop.instance()
+        self.queue = Queue.Queue()
+        for i in xrange(size):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def run(self, func, kwargs):
+        d = defer.Deferred()
+        self.queue.put((d, func, kwargs))
+        return d
+
+    def _work(self):
+        while True:
+            d, func, kwargs = self.queue.get()
+            try:
+                fire = functools.partial(d.callback, func(**kwargs))
+            except:
+                fire = functools.partial(d.errback, failure.Failure())
+            self.io_inst.add_callback(fire)
+
+
+_worker_pool = None
+
+
+def worker_pool():
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = WorkerPool(FLAGS.rpc_worker_threads)
+    return _worker_pool
+
+
 class AdapterConsumer(TopicConsumer):
+    """ Calls proxy methods for the messages on a topic.
+
+    Messages are acked as soon as their method starts, except for methods
+    marked rpc.blocking: at most FLAGS.rpc_max_inflight of those run at
+    once and each is acked when its worker returns, so with prefetch the
+    broker holds the rest back and anything delivered beyond the limit
+    waits in a backlog.  Other methods may return Deferreds that fire
+    much later, or never, so they don't count against the limit.
+    """
     def __init__(self, connection=None, topic="broadcast", proxy=None):
         _log.debug('Initing the Adapter Consumer for %s' % (topic))
         self.proxy = proxy
+        self.prefetch_count = FLAGS.rpc_prefetch_count
+        self.inflight = 0
+        self.backlog = collections.deque()
         super(AdapterConsumer, self).__init__(connection=connection, topic=topic)
- 
+
+    def full(self):
+        return (FLAGS.rpc_max_inflight and
+                self.inflight >= FLAGS.rpc_max_inflight)
+
+    def fetch(self, *args, **kwargs):
+        # polled backends simply stop fetching while we're at the limit
+        if self.full():
+            return None
+        return super(AdapterConsumer, self).fetch(*args, **kwargs)
+
     def receive(self, message_data, message):
+        if self.full():
+            self.backlog.append((message_data, message))
+            return
+        self._process(message_data, message)
+
+    def _process(self, message_data, message):
         _log.debug('received %s' % (message_data))
         msg_id = message_data.pop('_msg_id', None)
+        reply_to = message_data.pop('_reply_to', None)
+        sent_at = message_data.pop('_sent_at', None)
 
         method = message_data.get('method')
         args = message_data.get('args', {})
+        start = time.time()
+        if sent_at:
+            # only as good as the clocks of the two hosts agree
+            record('queue', self.queue, method, max(0, start - sent_at))
         if not method:
+            message.ack()
             return
 
-        node_func = getattr(self.proxy, str(method))     
+        node_func = getattr(self.proxy, str(method))
         node_args = dict((str(k), v) for k, v in args.iteritems())
-        d = defer.maybeDeferred(node_func, **node_args)
+        if getattr(node_func, 'blocking', False):
+            self.inflight += 1
+            d = worker_pool().run(node_func, node_args)
+            d.addBoth(self._release, message)
+        else:
+            message.ack()
+            d = defer.maybeDeferred(node_func, **node_args)
+        d.addBoth(self._record_handler, method, start)
         if msg_id:
-            d.addCallback(lambda rval: msg_reply(msg_id, rval))
-            d.addErrback(lambda e: msg_reply(msg_id, str(e)))
+            content_type = message.content_type
+            d.addCallback(lambda rval: msg_reply(msg_id, rval, reply_to,
+                                                 content_type))
+            d.addErrback(lambda e: msg_reply(msg_id, str(e), reply_to,
+                                             content_type))
+
+    def _record_handler(self, result, method, start):
+        record('handler', self.queue, method, time.time() - start)
+        return result
+
+    def _release(self, result, message):
         message.ack()
-        return
+        self.inflight -= 1
+        while self.backlog and not self.full():
+            self._process(*self.backlog.popleft())
+        return result
 
 
 class TopicPublisher(Publisher):
@@ -119,48 +692,214 @@ class DirectPublisher(Publisher):
         super(DirectPublisher, self).__init__(connection=connection)
 
 
-def msg_reply(msg_id, reply):
+class ReplyConsumer(DirectConsumer):
+    """ The process's reply queue, shared by every outstanding call.
+
+    Replies carry the _msg_id of the call they answer and are handed to the
+    Deferred waiting on it, so a call costs no declarations of its own.
+    """
+    def __init__(self, connection=None):
+        super(ReplyConsumer, self).__init__(
+                connection=connection, msg_id='reply_%s' % uuid.uuid4().hex)
+        self.pending = {}
+        self.register_callback(self._dispatch)
+        self.amqp = self.connection.connection
+        self.injected_loop = ioloop.IOLoop.instance()
+        self.injected = self.attach_to_tornado(self.injected_loop)
+
+    @property
+    def stale(self):
+        """ Whether our queue may be gone: the connection we declared it on
+        has been replaced, or its socket was lost """
+        reader = getattr(self.injected, 'reader', None)
+        return (self.connection.connection is not self.amqp or
+                (reader is not None and reader.closed))
+
+    def _dispatch(self, message_data, message):
+        message.ack()
+        msg_id = message_data.pop('_msg_id', None)
+        if msg_id not in self.pending:
+            _log.warn('Dropping reply for unknown call %s' % (msg_id))
+            return
+        self._forget(msg_id).callback(message_data)
+
+    def _forget(self, msg_id):
+        d, timeout = self.pending.pop(msg_id)
+        if timeout is not None:
+            self.injected_loop.remove_timeout(timeout)
+        return d
+
+    def _timeout(self, msg_id, seconds):
+        if msg_id not in self.pending:
+            return
+        _log.warn('Call %s timed out after %ss, %d calls outstanding' %
+                  (msg_id, seconds, self.outstanding - 1))
+        # the loop has already dropped this timeout, so don't _forget it
+        d, _timeout = self.pending.pop(msg_id)
+        d.errback(defer.TimeoutError(
+                'no reply to %s after %ss' % (msg_id, seconds)))
+
+    def _cancel(self, msg_id):
+        if msg_id in self.pending:
+            self._forget(msg_id)
+
+    @property
+    def outstanding(self):
+        """ How many calls are still waiting for a reply """
+        return len(self.pending)
+
+    def wait_for(self, msg_id, timeout=None):
+        """ A Deferred for the reply to msg_id.
+
+        It errbacks with TimeoutError after timeout seconds, and cancelling
+        it stops waiting; either way the call is forgotten.
+        """
+        d = defer.Deferred(lambda d: self._cancel(msg_id))
+        handle = None
+        if timeout:
+            handle = self.injected_loop.add_timeout(
+                    time.time() + timeout,
+                    lambda: self._timeout(msg_id, timeout))
+        self.pending[msg_id] = (d, handle)
+        return d
+
+
+_reply_consumer = None
+
+
+def outstanding_calls():
+    """ Gauge of rpc.calls in this process still waiting for a reply """
+    if _reply_consumer is None:
+        return 0
+    return _reply_consumer.outstanding
+
+
+def reply_consumer():
+    """ The ReplyConsumer for this process, created on first use and again
+    whenever the connection it was declared on goes away """
+    global _reply_consumer
+    if _reply_consumer is not None and _reply_consumer.stale:
+        reset_reply_consumer()
+    if _reply_consumer is None:
+        _reply_consumer = ReplyConsumer(connection=Connection.instance())
+    return _reply_consumer
+
+
+def reset_reply_consumer():
+    """ Stop using the current reply queue; the next call declares another.
+
+    Calls still waiting on the old queue are left to their timeouts.
+    """
+    global _reply_consumer
+    consumer, _reply_consumer = _reply_consumer, None
+    if consumer is None:
+        return
+    try:
+        consumer.injected.stop()
+    except (amqp_exceptions.AMQPException, socket.error, IOError), e:
+        _log.warn('Could not cancel reply consumer: %s' % (e,))
+
+
+# fakerabbit forgets every queue when reset, ours included
+fakerabbit.on_reset(reset_reply_consumer)
+
+
+def msg_reply(msg_id, reply, reply_to=None, content_type=None):
     conn = Connection.instance()
-    publisher = DirectPublisher(connection=conn, msg_id=msg_id)
-    
+    if reply_to:
+        serializer = conn.negotiate(content_type)
+        send = lambda data: conn.publishers.direct(reply_to, data,
+                                                   serializer)
+    else:
+        # callers that predate the shared reply queue listen on msg_id
+        # itself, which is used once so isn't worth pooling
+        publisher = DirectPublisher(connection=conn, msg_id=msg_id)
+        send = publisher.send
+
     try:
-        publisher.send({'result': reply})
-    except TypeError:
-        publisher.send(
-                {'result': dict((k, repr(v)) 
-                                for k, v in reply.__dict__.iteritems())
-                 })
-    publisher.close()
+        send({'result': reply, '_msg_id': msg_id})
+    except (TypeError, ValueError):
+        send({'result': dict((k, repr(v))
+                             for k, v in reply.__dict__.iteritems()),
+              '_msg_id': msg_id})
+    if not reply_to:
+        publisher.close()
+
 
+def call(topic, msg, timeout=None):
+    """ Send msg to topic, returning a Deferred for the reply.
 
-def call(topic, msg):
+    The Deferred errbacks with defer.TimeoutError if no reply arrives within
+    timeout seconds (FLAGS.rpc_timeout by default) and can be cancelled.
+    """
     _log.debug("Making asynchronous call...")
-    msg_id = uuid.uuid4().hex
-    msg.update({'_msg_id': msg_id})
-    _log.debug("MSG_ID is %s" % (msg_id))
-    
-    conn = Connection.instance()
-    d = defer.Deferred()
-    consumer = DirectConsumer(connection=conn, msg_id=msg_id)
-    consumer.register_callback(lambda data, message: d.callback(data))
-    injected = consumer.attach_to_tornado()
+    return _call_many([(topic, msg)], timeout)[0]
 
-    # clean up after the injected listened and return x
-    d.addCallback(lambda x: injected.stop() and x or x)
 
-    publisher = TopicPublisher(connection=conn, topic=topic)
-    publisher.send(msg)
-    publisher.close()
-    return d
+def call_many(messages, timeout=None):
+    """ rpc.call each (topic, msg) pair, publishing them all at once.
+
+    Returns a DeferredList of the replies, in the order of messages.
+    """
+    return defer.DeferredList(_call_many(messages, timeout),
+                              consumeErrors=True)
+
+
+def _call_many(messages, timeout):
+    replies = reply_consumer()
+    if timeout is None:
+        timeout = FLAGS.rpc_timeout
+    msg_ids = []
+    ds = []
+    for topic, msg in messages:
+        msg_id = uuid.uuid4().hex
+        msg.update({'_msg_id': msg_id, '_reply_to': replies.queue})
+        _log.debug("MSG_ID is %s" % (msg_id))
+        msg_ids.append(msg_id)
+        d = replies.wait_for(msg_id, timeout)
+        d.addCallback(_record_reply, topic, msg.get('method'), time.time())
+        ds.append(d)
+
+    conn = Connection.instance()
+    try:
+        _publish_many(conn, messages)
+    except:
+        for msg_id in msg_ids:
+            replies._cancel(msg_id)
+        raise
+    return ds
 
 
 def cast(topic, msg):
     _log.debug("Making asynchronous cast...")
-    conn = Connection.instance()
-    publisher = TopicPublisher(connection=conn, topic=topic)
-    publisher.send(msg)
-    publisher.close()
+    cast_many([(topic, msg)])
+
 
+def cast_many(messages):
+    """ rpc.cast each (topic, msg) pair, publishing them all at once """
+    _publish_many(Connection.instance(), messages)
+
+
+def _record_reply(result, topic, method, start):
+    record('reply', topic, method, time.time() - start)
+    return result
+
+
+def _publish_many(conn, messages):
+    if not messages:
+        return
+    start = time.time()
+    for topic, msg in messages:
+        msg['_sent_at'] = start
+    with _corked(conn):
+        if len(messages) == 1:
+            conn.publishers.topic(*messages[0])
+        else:
+            conn.publishers.topics(messages)
+    _drain_pending(conn)
+    elapsed = (time.time() - start) / len(messages)
+    for topic, msg in messages:
+        record('publish', topic, msg.get('method'), elapsed)
 
 
 def generic_response(message_data, message):
@@ -23,6 +23,7 @@ from auth.tests import *
 from volume.tests.storage_unittest import *
 from endpoint.tests.network_unittest import *
 from objectstore.tests.objectstore_unittest import *
+from nova.tests import *
 
 if __name__ == '__main__':
     unittest.main()
@@ -25,6 +25,8 @@ flags.DEFINE_bool('daemonize', False, 'daemonize this process')
 flags.DEFINE_bool('use_syslog', True, 'output to syslog when daemonizing')
 flags.DEFINE_string('logfile', None, 'log file to output to')
 flags.DEFINE_string('pidfile', None, 'pid file to output to')
+flags.DEFINE_string('statsfile', None,
+                    'file rpc timings are dumped to on SIGUSR1')
 flags.DEFINE_string('working_directory', './', 'working directory...')
 
 
@@ -60,11 +62,19 @@ def stop(pidfile):
             sys.exit(1)
 
 
+def dump_stats(signum, frame):
+    # not at the top, so daemons that don't use rpc don't need carrot
+    import rpc
+    rpc.dump_stats(FLAGS.statsfile)
+
+
 def serve(name, main):
     argv = FLAGS(sys.argv)
 
     if not FLAGS.pidfile:
         FLAGS.pidfile = '%s.pid' % name
+    if not FLAGS.statsfile:
+        FLAGS.statsfile = '%s.stats' % name
 
     logging.debug("Full set of FLAGS: \n\n\n" )
     for flag in FLAGS:
@@ -109,6 +119,9 @@ def serve(name, main):
     else:
         logging.getLogger().setLevel(logging.WARNING)
 
+    signal_map = daemon.daemon.make_default_signal_map()
+    signal_map[signal.SIGUSR1] = dump_stats
+
     with daemon.DaemonContext(
             detach_process=FLAGS.daemonize,
             working_directory=FLAGS.working_directory,
@@ -117,6 +130,7 @@ def serve(name, main):
                                                    threaded=False),
             stdin=stdin,
             stdout=stdout,
-            stderr=stderr
+            stderr=stderr,
+            signal_map=signal_map
             ):
         main(argv)
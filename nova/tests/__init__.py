@@ -0,0 +1,6 @@
+from datastore_unittest import KeeperTestCase, LogKeeperTestCase
+from fakerabbit_unittest import FakeRabbitTestCase
+from rpc_unittest import RpcTestCase
+
+__all__ = ['KeeperTestCase', 'LogKeeperTestCase',
+           'FakeRabbitTestCase', 'RpcTestCase']
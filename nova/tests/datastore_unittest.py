@@ -0,0 +1,357 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import copy
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import contrib
+from tornado import ioloop
+
+from nova import datastore
+from nova import flags
+
+FLAGS = flags.FLAGS
+
+
+class KeeperTestCase(unittest.TestCase):
+    backend = 'file'
+
+    def setUp(self):
+        super(KeeperTestCase, self).setUp()
+        logging.getLogger().setLevel(logging.DEBUG)
+        self.saved = dict((name, getattr(FLAGS, name)) for name in
+                          ('datastore_path', 'datastore_backend',
+                           'datastore_cache_size',
+                           'datastore_log_compact_size',
+                           'datastore_format', 'datastore_compress_size'))
+        self.path = tempfile.mkdtemp()
+        FLAGS.datastore_path = self.path
+        FLAGS.datastore_backend = self.backend
+        datastore._cache.clear()
+        self.keeper = datastore.keeper('test-')
+
+    def tearDown(self):
+        super(KeeperTestCase, self).tearDown()
+        for name, value in self.saved.iteritems():
+            setattr(FLAGS, name, value)
+        datastore._backends.pop((self.backend, self.path), None)
+        datastore._indexes.pop(self.keeper.prefix, None)
+        for (backend, io_loop), watcher in datastore._watchers.items():
+            if backend.path == self.path:
+                io_loop.remove_handler(watcher.inotify.fd)
+                os.close(watcher.inotify.fd)
+                del datastore._watchers[(backend, io_loop)]
+        datastore._cache.clear()
+        shutil.rmtree(self.path)
+
+    def _other_process(self):
+        """ A backend of our own on the same path, as another process has """
+        return datastore._BACKENDS[self.backend](self.path)
+
+    def test_read_write_delete(self):
+        self.assertEqual(self.keeper['a'], None)
+        self.keeper['a'] = {'n': 1}
+        self.assertEqual(self.keeper['a'], {'n': 1})
+        del self.keeper['a']
+        self.assertEqual(self.keeper['a'], None)
+
+    def test_cache_shares_values(self):
+        self.keeper['a'] = {'hosts': ['10.0.0.2']}
+        self.assert_(self.keeper['a'] is self.keeper['a'])
+
+    def test_values_are_read_only(self):
+        self.keeper['a'] = {'hosts': ['10.0.0.2']}
+        value = self.keeper['a']
+        self.assertRaises(TypeError, value.__setitem__, 'vlan', 100)
+        self.assertRaises(TypeError, value.update, {'vlan': 100})
+        self.assertRaises(TypeError, value['hosts'].append, '10.0.0.3')
+        changed = copy.deepcopy(value)
+        changed['hosts'].append('10.0.0.3')
+        self.assertEqual(type(changed), dict)
+        self.assertEqual(type(changed['hosts']), list)
+        self.assertEqual(self.keeper['a'], {'hosts': ['10.0.0.2']})
+
+    def test_cache_sees_writes_by_other_processes(self):
+        self.keeper['a'] = {'n': 1}
+        self.assertEqual(self.keeper['a'], {'n': 1})
+        self._other_process().commit({'test-a': datastore._encode({'n': 2})})
+        self.assertEqual(self.keeper['a'], {'n': 2})
+        self._other_process().commit({'test-a': datastore._DELETED})
+        self.assertEqual(self.keeper['a'], None)
+
+    def test_cache_keeps_most_recently_used(self):
+        FLAGS.datastore_cache_size = 2
+        for item in ('a', 'b', 'c'):
+            self.keeper[item] = {'item': item}
+        for item in ('a', 'b', 'a', 'c'):
+            self.keeper[item]
+        cached = [key for path, key in datastore._cache._entries]
+        self.assertEqual(cached, ['test-a', 'test-c'])
+
+    def test_cache_can_be_disabled(self):
+        FLAGS.datastore_cache_size = 0
+        self.keeper['a'] = {'n': 1}
+        self.assertEqual(self.keeper['a'], {'n': 1})
+        self.assertEqual(len(datastore._cache._entries), 0)
+
+    def test_transaction_commits_together(self):
+        other = self._other_process()
+        with self.keeper.transaction():
+            self.keeper['a'] = {'n': 1}
+            self.keeper['b'] = {'n': 2}
+            self.assertEqual(self.keeper['a'], {'n': 1})
+            self.assertEqual(self.keeper.keys(), ['a', 'b'])
+            self.assertEqual(other.read('test-a'), None)
+        self.assertEqual(self.keeper['a'], {'n': 1})
+        self.assertEqual(self.keeper['b'], {'n': 2})
+
+    def test_transaction_discards_on_error(self):
+        self.keeper['a'] = {'n': 1}
+        def fail():
+            with self.keeper.transaction():
+                self.keeper['a'] = {'n': 2}
+                del self.keeper['a']
+                self.keeper['b'] = {'n': 3}
+                raise ValueError()
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(self.keeper['a'], {'n': 1})
+        self.assertEqual(self.keeper['b'], None)
+
+    def test_nested_transactions_join_the_outer_one(self):
+        with self.keeper.transaction():
+            with self.keeper.transaction():
+                self.keeper['a'] = {'n': 1}
+            self.assertEqual(self._other_process().read('test-a'), None)
+        self.assertEqual(self.keeper['a'], {'n': 1})
+
+    def test_transaction_deletes(self):
+        self.keeper['a'] = {'n': 1}
+        with self.keeper.transaction():
+            del self.keeper['a']
+            self.assertEqual(self.keeper['a'], None)
+            self.assertEqual(self.keeper.keys(), [])
+        self.assertEqual(self.keeper['a'], None)
+
+    def test_unchanged_values_are_not_rewritten(self):
+        self.keeper['a'] = {'n': 1}
+        backend = datastore._get_backend()
+        stamp = backend.stamp('test-a')
+        with self.keeper.transaction():
+            self.keeper['a'] = {'n': 1}
+        self.assertEqual(backend.stamp('test-a'), stamp)
+
+
+    def test_keys_and_scan_by_prefix(self):
+        self.keeper['user-a'] = {'n': 1}
+        self.keeper['user-b'] = {'n': 2}
+        self.keeper['vlan-a'] = {'n': 3}
+        self.assertEqual(self.keeper.keys('user-'), ['user-a', 'user-b'])
+        self.assertEqual(list(self.keeper.scan('user-')),
+                         [('user-a', {'n': 1}), ('user-b', {'n': 2})])
+        self.assertEqual(len(self.keeper.keys()), 3)
+
+    def test_find_without_index_scans(self):
+        self.keeper['a'] = {'owner': 'joe'}
+        self.keeper['b'] = {'owner': 'bob'}
+        self.assertEqual(self.keeper.find('owner', 'joe'),
+                         [('a', {'owner': 'joe'})])
+
+    def test_find_with_index(self):
+        self.keeper['a'] = {'owner': 'joe', 'groups': ['x', 'y']}
+        self.keeper.add_index('owner')
+        self.keeper.add_index('groups')
+        self.assertEqual(self.keeper.find('owner', 'joe'),
+                         [('a', {'owner': 'joe', 'groups': ['x', 'y']})])
+        self.assertEqual([item for item, value in
+                          self.keeper.find('groups', 'y')], ['a'])
+        # the index items don't show up as items
+        self.assertEqual(self.keeper.keys(), ['a'])
+
+    def test_index_follows_writes(self):
+        self.keeper.add_index('owner')
+        self.keeper['a'] = {'owner': 'joe'}
+        self.assertEqual(self.keeper.find('owner', 'joe'),
+                         [('a', {'owner': 'joe'})])
+        self.keeper['b'] = {'owner': 'joe'}
+        self.keeper['a'] = {'owner': 'bob'}
+        self.assertEqual([item for item, value in
+                          self.keeper.find('owner', 'joe')], ['b'])
+        self.assertEqual([item for item, value in
+                          self.keeper.find('owner', 'bob')], ['a'])
+        with self.keeper.transaction():
+            del self.keeper['b']
+            self.keeper['c'] = {'owner': 'joe'}
+        self.assertEqual([item for item, value in
+                          self.keeper.find('owner', 'joe')], ['c'])
+        del self.keeper['c']
+        self.assertEqual(self.keeper.find('owner', 'joe'), [])
+
+    def test_index_stores_one_item_per_value(self):
+        self.keeper.add_index('owner')
+        self.keeper['a'] = {'owner': 'joe'}
+        self.keeper['b'] = {'owner': 'bob'}
+        self.keeper.find('owner', 'joe')
+        self.assertEqual(self.keeper[datastore._index_item('owner', u'joe')],
+                         ['a'])
+        self.assertEqual(self.keeper[datastore._index_item('owner', u'bob')],
+                         ['b'])
+        long_value = u'x' * 200
+        self.keeper['c'] = {'owner': long_value}
+        self.assertEqual([item for item, value in
+                          self.keeper.find('owner', long_value)], ['c'])
+
+    def _watch(self, prefix, callback, io_loop):
+        try:
+            return self.keeper.watch(prefix, callback, io_loop=io_loop)
+        except (NotImplementedError, OSError):
+            logging.debug("Can't test watches without inotify.")
+            return None
+
+    def _run_until(self, io_loop, done, timeout=5):
+        """ Run io_loop until done() or timeout seconds have passed """
+        end = time.time() + timeout
+        def check():
+            if done() or time.time() > end:
+                io_loop.stop()
+            else:
+                io_loop.add_timeout(time.time() + 0.01, check)
+        io_loop.add_callback(check)
+        io_loop.start()
+
+    def test_watch_reports_changes(self):
+        io_loop = ioloop.IOLoop()
+        seen = set()
+        watch = self._watch('user-', seen.add, io_loop)
+        if watch is None:
+            return
+        self.keeper['user-a'] = {'n': 1}
+        self._other_process().commit({
+                'test-user-b': datastore._encode({'n': 2}),
+                'test-vlan-a': datastore._encode({'n': 3})})
+        self._run_until(io_loop, lambda: len(seen) >= 2)
+        self.assertEqual(sorted(seen), ['user-a', 'user-b'])
+
+        seen.clear()
+        del self.keeper['user-a']
+        self._run_until(io_loop, lambda: seen)
+        self.assertEqual(sorted(seen), ['user-a'])
+
+        watch.stop()
+        seen.clear()
+        self.keeper['user-c'] = {'n': 4}
+        self._run_until(io_loop, lambda: seen, timeout=0.2)
+        self.assertEqual(seen, set())
+
+    def test_watch_drops_stale_cache_entries(self):
+        io_loop = ioloop.IOLoop()
+        seen = set()
+        if self._watch('', seen.add, io_loop) is None:
+            return
+        self.keeper['a'] = {'n': 1}
+        self._run_until(io_loop, lambda: seen)
+        self.keeper['a']
+        self.assert_((self.path, 'test-a') in datastore._cache._entries)
+        seen.clear()
+        self._other_process().commit({'test-a': datastore._encode({'n': 2})})
+        self._run_until(io_loop, lambda: seen)
+        self.assert_((self.path, 'test-a') not in datastore._cache._entries)
+        self.assertEqual(self.keeper['a'], {'n': 2})
+
+    def _raw(self, item):
+        return datastore._get_backend().read(self.keeper._key(item))
+
+    def test_json_values_have_no_header(self):
+        FLAGS.datastore_format = 'json'
+        self.keeper['a'] = {'n': 1}
+        self.assertEqual(datastore._decode(self._raw('a')), {'n': 1})
+        self.assert_(not self._raw('a').startswith(datastore._MAGIC))
+
+    def test_marshal_values_read_back_like_json(self):
+        value = {'name': 'joe', 'ports': (1, 2), 1: None, 'on': True,
+                 'nested': {'hosts': ['10.0.0.2']}}
+        FLAGS.datastore_format = 'json'
+        self.keeper['json'] = value
+        FLAGS.datastore_format = 'marshal'
+        self.keeper['marshal'] = value
+        self.assert_(self._raw('marshal').startswith(datastore._MAGIC))
+        datastore._cache.clear()
+        from_json = self.keeper['json']
+        from_marshal = self.keeper['marshal']
+        self.assertEqual(from_marshal, from_json)
+        self.assertEqual(type(from_marshal['name']), unicode)
+        self.assertEqual(type(from_marshal['ports']),
+                         type(from_json['ports']))
+        self.assertEqual(sorted(from_marshal.keys()),
+                         [u'1', u'name', u'nested', u'on', u'ports'])
+
+    def test_marshal_refuses_what_json_cannot_store(self):
+        FLAGS.datastore_format = 'marshal'
+        self.assertRaises(TypeError, self.keeper.__setitem__, 'a',
+                          {'when': set([1])})
+
+    def test_large_values_are_compressed(self):
+        FLAGS.datastore_compress_size = 64
+        value = {'hosts': ['10.0.0.%d' % i for i in xrange(100)]}
+        for codec in ('json', 'marshal'):
+            FLAGS.datastore_format = codec
+            self.keeper[codec] = value
+            raw = self._raw(codec)
+            self.assert_(raw.startswith(datastore._MAGIC))
+            self.assert_(len(raw) < len(datastore._CODECS[codec][1](value)))
+            datastore._cache.clear()
+            self.assertEqual(self.keeper[codec], value)
+
+    def test_unknown_format_version_is_refused(self):
+        data = datastore._MAGIC + '\x7fj\x00{}'
+        self.assertRaises(ValueError, datastore._decode, data)
+
+class LogKeeperTestCase(KeeperTestCase):
+    """ The same again, and compaction, with everything in one log """
+    backend = 'log'
+
+    def _log_size(self):
+        return os.path.getsize(os.path.join(self.path, 'keeper.log'))
+
+    def test_reopened_log_has_latest_values(self):
+        self.keeper['a'] = {'n': 1}
+        self.keeper['a'] = {'n': 2}
+        self.keeper['b'] = {'n': 3}
+        del self.keeper['b']
+        other = self._other_process()
+        self.assertEqual(other.keys('test-'), ['test-a'])
+        self.assertEqual(datastore._decode(other.read('test-a')), {'n': 2})
+
+    def test_torn_tail_is_ignored_and_truncated(self):
+        self.keeper['a'] = {'n': 1}
+        size = self._log_size()
+        with open(os.path.join(self.path, 'keeper.log'), 'a') as f:
+            f.write('P\x00\x00')
+        other = self._other_process()
+        self.assertEqual(other.keys('test-'), ['test-a'])
+        other.commit({'test-b': datastore._encode({'n': 2})})
+        self.assertEqual(self.keeper['b'], {'n': 2})
+        self.assertEqual(self._log_size(),
+                         size + len(other._pack('test-b',
+                                                datastore._encode({'n': 2}))))
+
+    def test_compaction_drops_dead_records(self):
+        for i in xrange(200):
+            self.keeper['a'] = {'n': i}
+            self.keeper['b'] = {'n': -i}
+        self.assert_(self._log_size() > 1024)
+        # the next commit starts it
+        FLAGS.datastore_log_compact_size = 1024
+        self.keeper['a'] = {'n': 200}
+        backend = datastore._get_backend()
+        for i in xrange(100):
+            if not backend._compacting:
+                break
+            time.sleep(0.01)
+        self.assert_(self._log_size() < 1024)
+        self.assertEqual(self.keeper['a'], {'n': 200})
+        self.assertEqual(self.keeper['b'], {'n': -199})
+        other = self._other_process()
+        self.assertEqual(other.keys('test-'), ['test-a', 'test-b'])
@@ -0,0 +1,107 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import logging
+import time
+
+import contrib
+from twisted.internet import defer
+
+import fakerabbit
+import flags
+import test
+
+FLAGS = flags.FLAGS
+
+
+class FakeRabbitTestCase(test.BaseTestCase):
+    def setUp(self):
+        super(FakeRabbitTestCase, self).setUp()
+        logging.getLogger().setLevel(logging.DEBUG)
+        self.delivery = FLAGS.fake_rabbit_delivery
+        self.backend = fakerabbit.Backend()
+        self.backend.exchange_declare('nova', 'topic')
+        self.backend.queue_declare('test')
+        self.backend.queue_bind('test', 'nova', 'test')
+        self.received = []
+
+    def tearDown(self):
+        FLAGS.fake_rabbit_delivery = self.delivery
+        super(FakeRabbitTestCase, self).tearDown()
+
+    def _publish(self, *bodies):
+        for body in bodies:
+            self.backend.publish((body, 'text/plain', 'utf-8'),
+                                 'nova', 'test')
+
+    def _consume(self, tag='tag'):
+        self.backend.declare_consumer(
+                queue='test', no_ack=False, consumer_tag=tag,
+                callback=lambda message: self.received.append(
+                        (tag, message[0])))
+
+    def _sleep(self, seconds):
+        d = defer.Deferred()
+        self.ioloop.add_timeout(time.time() + seconds,
+                                lambda: d.callback(None))
+        return d
+
+    def test_poll_queues_until_fetched(self):
+        FLAGS.fake_rabbit_delivery = 'poll'
+        self.assert_(not self.backend.pushes)
+        self._consume()
+        self._publish('a', 'b')
+        self.assertEqual(self.received, [])
+        self.assertEqual(self.backend.get('test').body, 'a')
+        self.assertEqual(self.backend.get('test').body, 'b')
+        self.assertEqual(self.backend.get('test'), None)
+
+    def test_direct_delivers_as_published(self):
+        FLAGS.fake_rabbit_delivery = 'direct'
+        self.assert_(self.backend.pushes)
+        self._publish('queued')
+        self._consume()
+        self.assertEqual(self.received, [('tag', 'queued')])
+        self._publish('a')
+        self.assertEqual(self.received, [('tag', 'queued'), ('tag', 'a')])
+
+    def test_direct_round_robins_between_consumers(self):
+        FLAGS.fake_rabbit_delivery = 'direct'
+        self._consume('one')
+        self._consume('two')
+        self._publish('a', 'b', 'c')
+        self.assertEqual(self.received,
+                         [('one', 'a'), ('two', 'b'), ('one', 'c')])
+        self.backend.cancel('one')
+        self._publish('d')
+        self.assertEqual(self.received[-1], ('two', 'd'))
+
+    def test_deferred_delivers_on_the_next_iteration(self):
+        FLAGS.fake_rabbit_delivery = 'deferred'
+        self._consume()
+        self._publish('a', 'b')
+        self.assertEqual(self.received, [])
+        yield self._sleep(0.01)
+        self.assertEqual(self.received, [('tag', 'a'), ('tag', 'b')])
+
+    def test_deferred_keeps_messages_when_consumer_goes(self):
+        FLAGS.fake_rabbit_delivery = 'deferred'
+        self._consume()
+        self._publish('a')
+        self.backend.cancel('tag')
+        yield self._sleep(0.01)
+        self.assertEqual(self.received, [])
+        self.assertEqual(self.backend.get('test').body, 'a')
+
+    def test_stats_count_published_messages(self):
+        self._publish('a', 'bc')
+        self.assertEqual(fakerabbit.stats()['nova'],
+                         {'messages': 2, 'bytes': 3})
+
+    def test_reset_runs_hooks(self):
+        calls = []
+        fakerabbit.on_reset(lambda: calls.append(True))
+        try:
+            fakerabbit.reset_all()
+        finally:
+            fakerabbit._reset_hooks.pop()
+        self.assertEqual(calls, [True])
+        self.assertEqual(fakerabbit.stats(), {})
@@ -0,0 +1,378 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+import logging
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import contrib
+import anyjson
+from carrot import serialization
+from twisted.internet import defer
+
+import fakerabbit
+import flags
+import rpc
+import test
+
+FLAGS = flags.FLAGS
+
+
+class TestProxy(object):
+    def __init__(self):
+        self.release = threading.Event()
+        self.stuck = []
+        self.seen = []
+
+    def note(self, value):
+        self.seen.append(value)
+
+    def echo(self, value):
+        return value
+
+    def hang(self):
+        """ Returns a Deferred nothing ever fires """
+        d = defer.Deferred()
+        self.stuck.append(d)
+        return d
+
+    @rpc.blocking
+    def explode(self):
+        raise ValueError('boom')
+
+    @rpc.blocking
+    def wait(self):
+        self.release.wait(10)
+        return 'released'
+
+
+class FakePublisher(object):
+    """ Records what it sends; the first `failures` sends raise """
+    failures = 0
+
+    def __init__(self, connection=None, **kwargs):
+        self.sent = []
+        self.closed = False
+
+    def send(self, body, routing_key=None, **kwargs):
+        if FakePublisher.failures:
+            FakePublisher.failures -= 1
+            raise IOError('channel closed')
+        self.sent.append((routing_key, body))
+
+    def close(self):
+        self.closed = True
+
+
+class RpcTestCase(test.BaseTestCase):
+    def setUp(self):
+        super(RpcTestCase, self).setUp()
+        logging.getLogger().setLevel(logging.DEBUG)
+        self.delivery = FLAGS.fake_rabbit_delivery
+        self.pool_size = FLAGS.rpc_publisher_pool_size
+        self.stats_window = FLAGS.rpc_stats_window
+        self.conn = rpc.Connection.instance()
+        self.serializer = (self.conn.serializer, self.conn.compress_size)
+        self.proxy = TestProxy()
+        self.consumer = rpc.AdapterConsumer(connection=self.conn,
+                                            topic='test',
+                                            proxy=self.proxy)
+        self.injected.append(self.consumer.attach_to_tornado(self.ioloop))
+
+    def tearDown(self):
+        self.proxy.release.set()
+        FLAGS.fake_rabbit_delivery = self.delivery
+        FLAGS.rpc_publisher_pool_size = self.pool_size
+        FLAGS.rpc_stats_window = self.stats_window
+        self.conn.serializer, self.conn.compress_size = self.serializer
+        FakePublisher.failures = 0
+        super(RpcTestCase, self).tearDown()
+
+    def _sleep(self, seconds):
+        d = defer.Deferred()
+        self.ioloop.add_timeout(time.time() + seconds,
+                                lambda: d.callback(None))
+        return d
+
+    def test_stuck_handlers_do_not_wedge_consumer(self):
+        count = FLAGS.rpc_max_inflight + 4
+        rpc.cast_many([('test', {'method': 'hang', 'args': {}})
+                       for i in xrange(count)])
+        rv = yield rpc.call('test', {'method': 'echo',
+                                     'args': {'value': 42}}, timeout=5)
+        self.assertEqual(rv, {'result': 42})
+        self.assertEqual(len(self.proxy.stuck), count)
+        self.assertEqual(self.consumer.inflight, 0)
+        self.assertEqual(len(self.consumer.backlog), 0)
+
+    def test_blocking_calls_are_limited(self):
+        count = FLAGS.rpc_max_inflight + 2
+        replies = rpc.call_many([('test', {'method': 'wait', 'args': {}})
+                                 for i in xrange(count)], timeout=10)
+        yield self._sleep(0.1)
+        self.assertEqual(self.consumer.inflight, FLAGS.rpc_max_inflight)
+        self.proxy.release.set()
+        rv = yield replies
+        self.assertEqual([value for ok, value in rv], 
+                         [{'result': 'released'}] * count)
+        self.assertEqual(self.consumer.inflight, 0)
+        self.assertEqual(len(self.consumer.backlog), 0)
+
+    def test_pushed_messages_need_no_polling(self):
+        FLAGS.fake_rabbit_delivery = 'direct'
+        consumer = rpc.AdapterConsumer(connection=self.conn, topic='pushed',
+                                       proxy=self.proxy)
+        attached = consumer.attach_to_tornado(self.ioloop)
+        self.injected.append(attached)
+        self.assert_(isinstance(attached, rpc._Attached))
+        rpc.cast('pushed', {'method': 'note', 'args': {'value': 1}})
+        self.assertEqual(self.proxy.seen, [1])
+        attached.stop()
+        rpc.cast('pushed', {'method': 'note', 'args': {'value': 2}})
+        self.assertEqual(self.proxy.seen, [1])
+
+    def test_frame_source_waits_for_whole_frames(self):
+        class Transport(object):
+            pass
+        transport = Transport()
+        transport.sock, peer = socket.socketpair()
+        source = rpc._FrameSource(transport)
+        source.nonblocking = True
+        frame = struct.pack('>BHI', 1, 2, 5) + 'hello' + '\xce'
+        try:
+            self.assertRaises(rpc._WouldBlock, source.read_frame)
+            peer.sendall(frame[:6])
+            self.assertRaises(rpc._WouldBlock, source.read_frame)
+            peer.sendall(frame[6:] + frame)
+            self.assertEqual(source.read_frame(), (1, 2, 'hello'))
+            self.assertEqual(source.read_frame(), (1, 2, 'hello'))
+            self.assertRaises(rpc._WouldBlock, source.read_frame)
+        finally:
+            transport.sock.close()
+            peer.close()
+
+    def test_calls_share_one_reply_queue(self):
+        replies = rpc.reply_consumer()
+        calls = [rpc.call('test', {'method': 'echo', 'args': {'value': i}})
+                 for i in xrange(3)]
+        self.assertEqual(rpc.outstanding_calls(), 3)
+        rv = yield defer.gatherResults(calls)
+        self.assertEqual(rv, [{'result': 0}, {'result': 1}, {'result': 2}])
+        self.assert_(rpc.reply_consumer() is replies)
+        self.assertEqual(rpc.outstanding_calls(), 0)
+
+    def test_unknown_replies_are_dropped(self):
+        replies = rpc.reply_consumer()
+        d = rpc.call('test', {'method': 'hang', 'args': {}})
+        rpc.msg_reply('unknown', 'stray', replies.queue)
+        rv = yield rpc.call('test', {'method': 'echo', 'args': {'value': 1}})
+        self.assertEqual(rv, {'result': 1})
+        self.assertEqual(rpc.outstanding_calls(), 1)
+        d.cancel()
+        d.addErrback(lambda f: None)
+
+    def test_reply_queue_is_declared_again_after_reset(self):
+        replies = rpc.reply_consumer()
+        rpc.reset_reply_consumer()
+        rv = yield rpc.call('test', {'method': 'echo', 'args': {'value': 1}})
+        self.assertEqual(rv, {'result': 1})
+        self.assert_(rpc.reply_consumer() is not replies)
+
+    def test_call_times_out(self):
+        d = rpc.call('test', {'method': 'hang', 'args': {}}, timeout=0.1)
+        try:
+            yield d
+            self.fail('call should have timed out')
+        except defer.TimeoutError:
+            pass
+        self.assertEqual(rpc.outstanding_calls(), 0)
+
+    def test_late_replies_are_dropped(self):
+        d = rpc.call('test', {'method': 'wait', 'args': {}}, timeout=0.1)
+        try:
+            yield d
+            self.fail('call should have timed out')
+        except defer.TimeoutError:
+            pass
+        self.proxy.release.set()
+        rv = yield rpc.call('test', {'method': 'echo', 'args': {'value': 1}})
+        self.assertEqual(rv, {'result': 1})
+        self.assertEqual(rpc.outstanding_calls(), 0)
+
+    def test_cancelled_call_is_forgotten(self):
+        d = rpc.call('test', {'method': 'hang', 'args': {}}, timeout=10)
+        self.assertEqual(rpc.outstanding_calls(), 1)
+        d.cancel()
+        try:
+            yield d
+            self.fail('call should have been cancelled')
+        except defer.CancelledError:
+            pass
+        self.assertEqual(rpc.outstanding_calls(), 0)
+
+    def test_failed_publish_forgets_the_call(self):
+        def fail(*args, **kwargs):
+            raise IOError('connection lost')
+        self.stubs.Set(self.conn.publishers, 'topic', fail)
+        self.assertRaises(IOError, rpc.call, 'test',
+                          {'method': 'echo', 'args': {'value': 1}})
+        self.assertEqual(rpc.outstanding_calls(), 0)
+
+    def test_publishers_are_reused(self):
+        pool = rpc.PublisherPool(self.conn)
+        first = pool.get(FakePublisher, 'nova', 'a')
+        self.assert_(pool.get(FakePublisher, 'nova', 'a') is first)
+        self.assert_(pool.get(FakePublisher, 'nova', 'b') is not first)
+
+    def test_publisher_pool_closes_least_recently_used(self):
+        FLAGS.rpc_publisher_pool_size = 2
+        pool = rpc.PublisherPool(self.conn)
+        a = pool.get(FakePublisher, 'nova', 'a')
+        b = pool.get(FakePublisher, 'nova', 'b')
+        pool.get(FakePublisher, 'nova', 'a')
+        pool.get(FakePublisher, 'nova', 'c')
+        self.assert_(b.closed)
+        self.assert_(not a.closed)
+        self.assertEqual(sorted(pool.publishers), [('nova', 'a'),
+                                                   ('nova', 'c')])
+
+    def test_failed_send_is_retried_on_a_new_publisher(self):
+        pool = rpc.PublisherPool(self.conn)
+        broken = pool.get(FakePublisher, 'nova', 'a')
+        FakePublisher.failures = 1
+        pool.send(FakePublisher, 'nova', 'a', [('a', {'n': 1})])
+        self.assert_(broken.closed)
+        fresh = pool.publishers[('nova', 'a')]
+        self.assert_(fresh is not broken)
+        self.assertEqual([key for key, body in fresh.sent], ['a'])
+
+        FakePublisher.failures = 2
+        self.assertRaises(IOError, pool.send, FakePublisher, 'nova', 'a',
+                          [('a', {'n': 2})])
+        self.assertEqual(pool.publishers, {})
+
+    def test_casts_reuse_one_publisher(self):
+        rpc.cast('test', {'method': 'echo', 'args': {'value': 1}})
+        publishers = dict(self.conn.publishers.publishers)
+        rpc.cast('test', {'method': 'echo', 'args': {'value': 2}})
+        self.assertEqual(self.conn.publishers.publishers, publishers)
+
+    def test_cast_many_delivers_in_order(self):
+        rpc.cast_many([('test', {'method': 'note', 'args': {'value': i}})
+                       for i in xrange(5)])
+        for i in xrange(100):
+            if len(self.proxy.seen) == 5:
+                break
+            yield self._sleep(0.01)
+        self.assertEqual(self.proxy.seen, range(5))
+
+    def test_cast_many_sends_nothing_it_cannot_encode(self):
+        messages = [('test', {'method': 'note', 'args': {'value': 1}}),
+                    ('test', {'method': 'note', 'args': {'value': object()}})]
+        self.assertRaises(TypeError, rpc.cast_many, messages)
+        yield self._sleep(0.05)
+        self.assertEqual(self.proxy.seen, [])
+
+    def test_call_many_replies_in_order(self):
+        rv = yield rpc.call_many(
+                [('test', {'method': 'echo', 'args': {'value': 1}}),
+                 ('test', {'method': 'hang', 'args': {}}),
+                 ('test', {'method': 'echo', 'args': {'value': 2}})],
+                timeout=0.2)
+        self.assertEqual(rv[0], (True, {'result': 1}))
+        self.assertEqual(rv[1][0], False)
+        self.assert_(rv[1][1].check(defer.TimeoutError))
+        self.assertEqual(rv[2], (True, {'result': 2}))
+        self.assertEqual(rpc.outstanding_calls(), 0)
+
+    def test_worker_pool_fires_on_the_loop(self):
+        pool = rpc.WorkerPool(1, self.ioloop)
+        rv = yield pool.run(lambda: threading.current_thread().name, {})
+        self.assertNotEqual(rv, threading.current_thread().name)
+        try:
+            yield pool.run(self.proxy.explode, {})
+            self.fail('explode should have raised')
+        except ValueError:
+            pass
+
+    def test_blocking_errors_are_replied(self):
+        rv = yield rpc.call('test', {'method': 'explode', 'args': {}},
+                            timeout=5)
+        self.assert_('boom' in rv['result'])
+        self.assertEqual(self.consumer.inflight, 0)
+
+    def test_calls_are_timed_at_each_stage(self):
+        rpc._stats.clear()
+        yield rpc.call('test', {'method': 'echo', 'args': {'value': 1}})
+        stages = rpc.stats()['test']['echo']
+        self.assertEqual(sorted(stages),
+                         ['handler', 'publish', 'queue', 'reply'])
+        for stage in stages.values():
+            self.assertEqual(stage['count'], 1)
+
+    def test_histogram_keeps_a_window(self):
+        FLAGS.rpc_stats_window = 10
+        hist = rpc.Histogram()
+        for ms in xrange(1, 21):
+            hist.add(ms / 1000.0)
+        snapshot = hist.snapshot()
+        self.assertEqual(snapshot['count'], 20)
+        self.assertEqual(snapshot['window'], 10)
+        self.assertAlmostEqual(snapshot['p50'], 16)
+        self.assertAlmostEqual(snapshot['max'], 20)
+        self.assertEqual(snapshot['buckets'], {'20': 10})
+        self.assertEqual(rpc.Histogram().snapshot(), {'count': 0})
+
+    def test_dump_stats_writes_json(self):
+        rpc._stats.clear()
+        rpc.record('handler', 'test', 'echo', 0.002)
+        path = tempfile.mkdtemp()
+        try:
+            stats_file = os.path.join(path, 'rpc.json')
+            rpc.dump_stats(stats_file)
+            dumped = anyjson.deserialize(open(stats_file).read())
+            self.assertEqual(dumped['test']['echo']['handler']['count'], 1)
+            self.assertEqual(os.listdir(path), ['rpc.json'])
+        finally:
+            shutil.rmtree(path)
+
+    def _round_trip(self, conn, message_data):
+        content_type, content_encoding, body = conn.encode(message_data)
+        self.assertEqual(
+                serialization.registry.decode(body, content_type,
+                                              content_encoding),
+                message_data)
+        return content_type, body
+
+    def test_serializers_round_trip(self):
+        message_data = {'method': 'echo', 'args': {'value': [1, 2]}}
+        for name in ('json', 'marshal'):
+            conn = rpc.Connection(backend_cls=fakerabbit.Backend,
+                                  serializer=name, compress_size=0)
+            content_type, body = self._round_trip(conn, message_data)
+            self.assertEqual(conn.negotiate(content_type), name)
+
+    def test_large_messages_are_compressed(self):
+        message_data = {'method': 'echo', 'args': {'value': 'x' * 1000}}
+        for name in ('json', 'marshal'):
+            conn = rpc.Connection(backend_cls=fakerabbit.Backend,
+                                  serializer=name, compress_size=100)
+            content_type, body = self._round_trip(conn, message_data)
+            self.assert_(content_type.endswith('+zlib'))
+            self.assert_(len(body) < 100)
+            self.assertEqual(conn.negotiate(content_type), name)
+        conn = rpc.Connection(backend_cls=fakerabbit.Backend,
+                              serializer='json', compress_size=100)
+        content_type, content_encoding, body = conn.encode({'method': 'echo'})
+        self.assert_(not content_type.endswith('+zlib'))
+
+    def test_replies_use_the_request_serializer(self):
+        self.conn.serializer = 'marshal'
+        self.conn.compress_size = 100
+        value = ['10.0.0.%d' % i for i in xrange(100)]
+        rv = yield rpc.call('test', {'method': 'echo',
+                                     'args': {'value': value}})
+        self.assertEqual(rv, {'result': value})
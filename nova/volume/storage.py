@@ -6,6 +6,7 @@ Currently uses Ata-over-Ethernet.
 import logging
 import subprocess
 import random
+import threading
 import time
 
 from nova.utils import runthis, generate_uid
@@ -31,6 +32,10 @@ flags.DEFINE_string('storage_availability_zone',
                     'availability zone of this node')
 KEEPER = datastore.keeper(prefix="storage")
 
+# create_volume and delete_volume run on rpc.blocking's worker threads;
+# picking the next shelf.blade and exporting it must not interleave
+_export_lock = threading.Lock()
+
 class BlockStore(object):                                            
 
     def __init__(self):
@@ -41,6 +46,7 @@ class BlockStore(object):
         self._init_volume_group()
         pass
 
+    @rpc.blocking
     def create_volume(self, size, user_id):
         logging.debug("Creating volume of size: %s" % (size))
         vol = self.volume_class(size = size, user_id = user_id)
@@ -57,6 +63,7 @@ class BlockStore(object):
     def get_volume(self, volume_id):
         return self.volume_class(volume_id = volume_id)
 
+    @rpc.blocking
     def delete_volume(self, volume_id):
         logging.debug("Deleting volume with id of: %s" % (volume_id))
         return self.get_volume(volume_id).delete()
@@ -238,15 +245,17 @@ class Volume(object):
         runthis("Removing LV: %s", "sudo lvremove -f %s/%s" % (FLAGS.volume_group, self.volume_id))
 
     def _setup_export(self):
-        (shelf_id, blade_id) = get_next_aoe_numbers()
-        self.aoe_device = "e%s.%s" % (shelf_id, blade_id)
-        runthis("Creating AOE export: %s", 
-                "sudo vblade-persist setup %s %s %s /dev/%s/%s" % 
-                (shelf_id, blade_id, FLAGS.aoe_eth_dev, FLAGS.volume_group, self.volume_id))
+        with _export_lock:
+            (shelf_id, blade_id) = get_next_aoe_numbers()
+            self.aoe_device = "e%s.%s" % (shelf_id, blade_id)
+            runthis("Creating AOE export: %s", 
+                    "sudo vblade-persist setup %s %s %s /dev/%s/%s" % 
+                    (shelf_id, blade_id, FLAGS.aoe_eth_dev, FLAGS.volume_group, self.volume_id))
 
     def _remove_export(self):
-        runthis("Destroyed AOE export: %s", "sudo vblade-persist stop %s %s" % (self.aoe_device[1], self.aoe_device[3]))
-        runthis("Destroyed AOE export: %s", "sudo vblade-persist destroy %s %s" % (self.aoe_device[1], self.aoe_device[3]))
+        with _export_lock:
+            runthis("Destroyed AOE export: %s", "sudo vblade-persist stop %s %s" % (self.aoe_device[1], self.aoe_device[3]))
+            runthis("Destroyed AOE export: %s", "sudo vblade-persist destroy %s %s" % (self.aoe_device[1], self.aoe_device[3]))
 
 class FakeVolume(Volume):
     #def delete(self):